@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# vim: fileencoding=utf-8
+from __future__ import (unicode_literals, print_function, absolute_import)
+import timeit
+import fakeio
+
+LINE = b"2013-01-01 00:00:00 INFO something happened\n"
+
+def append_lines(count):
+    file = fakeio.FakeIOFile("/memfile/app.log", "rw", b'')
+    for _ in range(count):
+        fileobj = file.open('a')
+        fileobj.write(LINE)
+        fileobj.close()
+    return file.getvalue()
+
+def main():
+    print("%8s %14s %14s" % ("appends", "total (ms)", "per append (us)"))
+    for count in (1000, 10000, 50000):
+        elapsed = timeit.timeit(lambda: append_lines(count), number=1)
+        print("%8d %14.3f %14.3f" % (count, elapsed * 1e3,
+                                     elapsed / count * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# vim: fileencoding=utf-8
+from __future__ import (unicode_literals, print_function, absolute_import)
+import re
+import timeit
+import fakeio
+
+MISS_PATH = "/usr/lib/python2.7/os.py"
+
+def linear_match(regexes, path):
+    for regex in regexes:
+        if regex.match(path):
+            return True
+    return False
+
+def main():
+    print("%8s %14s %14s" % ("regexes", "linear (us)", "matcher (us)"))
+    for count in (1, 10, 100, 1000):
+        regexes = [re.compile("^/memfile%d/" % i) for i in range(count)]
+        matcher = fakeio._RegexMatcher()
+        for regex in regexes:
+            matcher.add(regex)
+        matcher.match(MISS_PATH)
+
+        number = 2000
+        linear = timeit.timeit(lambda: linear_match(regexes, MISS_PATH),
+                               number=number)
+        combined = timeit.timeit(lambda: matcher.match(MISS_PATH),
+                                 number=number)
+        print("%8d %14.3f %14.3f" % (count, linear / number * 1e6,
+                                     combined / number * 1e6))
+
+if __name__ == '__main__':
+    main()
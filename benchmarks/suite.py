@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# vim: fileencoding=utf-8
+# Benchmarks of the fakeio hot paths next to the same operations on real
+# files in tmpfs. Every result is printed as one JSON object per line, so
+# that runs can be stored and compared:
+#
+#   PYTHONPATH=. python benchmarks/suite.py [--quick] [--output FILE]
+from __future__ import (unicode_literals, print_function, absolute_import)
+import argparse
+import io
+import json
+import os
+import platform
+import re
+import shutil
+import sys
+import tempfile
+import timeit
+import fakeio
+
+LINE = b"2013-01-01 00:00:00 INFO something happened\n"
+CONTENT = LINE * 1000
+
+def _tmpfs_dir():
+    if os.path.isdir("/dev/shm"):
+        return tempfile.mkdtemp(dir="/dev/shm")
+    return tempfile.mkdtemp()
+
+def _rewound(fileobj):
+    fileobj.seek(0)
+    return fileobj
+
+def _per_call(func, number):
+    func()
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+
+def _session(files, regexes):
+    session = fakeio.FakeIOSession()
+    for i in range(files):
+        session.create_file("/memfile/%d.log" % i, 'rw', CONTENT)
+    for i in range(regexes):
+        session.intercept_regex(re.compile("^/memregex%d/" % i))
+    return session
+
+def _real_files(dirpath, files):
+    for i in range(files):
+        with open(os.path.join(dirpath, "%d.log" % i), 'wb') as fileobj:
+            fileobj.write(CONTENT)
+
+def bench_open(dirpath, sizes, number):
+    # Hit, miss and pass-through latency of open() as the session grows.
+    real_path = os.path.join(dirpath, "0.log")
+    for files in sizes:
+        for regexes in sizes:
+            session = _session(files, regexes)
+            with session:
+                hit = _per_call(lambda: open("/memfile/0.log").close(),
+                                number)
+                miss = _per_call(
+                    lambda: open("/memregex0/a.log").close(), number) \
+                    if regexes else None
+                passthrough = _per_call(lambda: open(real_path).close(),
+                                        number)
+            real = _per_call(lambda: open(real_path).close(), number)
+            yield 'open', {'files': files, 'regexes': regexes}, {
+                'hit': hit, 'regex': miss, 'passthrough': passthrough,
+                'real': real, 'hits_per_s': 1e6 / hit}
+
+def bench_read(dirpath, number):
+    # Throughput of the read paths of every opened file class.
+    real_path = os.path.join(dirpath, "0.log")
+    session = _session(1, 0)
+
+    def read(opener):
+        with opener() as fileobj:
+            fileobj.read()
+
+    def readline(opener):
+        with opener() as fileobj:
+            while fileobj.readline():
+                pass
+
+    def iterate(opener):
+        with opener() as fileobj:
+            for _ in fileobj:
+                pass
+
+    def readinto(opener):
+        buffer = bytearray(4096)
+        with opener() as fileobj:
+            while fileobj.readinto(buffer):
+                pass
+
+    openers = [
+        ('ReadOpenedFakeIOFile', lambda: open("/memfile/0.log"), True),
+        # Appending starts at the end, so rewind to read the content.
+        ('WriteOpenedFakeIOFile',
+         lambda: _rewound(open("/memfile/0.log", 'a')), True),
+        ('FakeTextIOFile', lambda: io.open("/memfile/0.log"), True),
+        ('FakeBinaryIOFile', lambda: io.open("/memfile/0.log", 'rb'), True),
+        ('file', lambda: open(real_path), False),
+        ('io.TextIOWrapper', lambda: io.open(real_path), False),
+        ('io.BufferedReader', lambda: io.open(real_path, 'rb'), False),
+        ]
+    for name, opener, fake in openers:
+        for operation in (read, readline, iterate, readinto):
+            if name == 'WriteOpenedFakeIOFile' and operation is not read:
+                continue
+            if operation is readinto and 'Binary' not in name and \
+                    'Buffered' not in name:
+                continue
+            if fake:
+                with session:
+                    elapsed = _per_call(lambda: operation(opener), number)
+            else:
+                elapsed = _per_call(lambda: operation(opener), number)
+            yield 'read', {'class': name, 'operation': operation.__name__}, {
+                'us': elapsed, 'mb_per_s': len(CONTENT) / elapsed}
+
+def bench_append(dirpath, sizes, number):
+    # Repeated open('a')/write/close, the pattern of log files.
+    real_path = os.path.join(dirpath, "append.log")
+    for count in sizes:
+        def fake():
+            fileobj = fakeio.FakeIOFile("/memfile/app.log", 'rw', b'')
+            for _ in range(count):
+                with fileobj.open('a') as writer:
+                    writer.write(LINE)
+
+        def real():
+            with open(real_path, 'wb'):
+                pass
+            for _ in range(count):
+                with open(real_path, 'ab') as writer:
+                    writer.write(LINE)
+
+        yield 'append', {'appends': count}, {
+            'fake': _per_call(fake, 1) / count,
+            'real': _per_call(real, 1) / count}
+
+def bench_mappings(sizes, number):
+    for files in sizes:
+        session = _session(files, 0)
+        yield 'mappings', {'files': files}, {
+            'us': _per_call(lambda: session.mappings, number)}
+
+def _object_bytes(obj):
+    size = sys.getsizeof(obj)
+    if hasattr(obj, '__dict__'):
+        size += sys.getsizeof(obj.__dict__)
+    return size
+
+def bench_footprint(sizes):
+    # Bytes a file takes besides its content, and bytes an open file takes.
+    for files in sizes:
+        session = _session(files, 0)
+        fileobjs = session.mappings.values()
+        per_file = sum(_object_bytes(fileobj) + _object_bytes(fileobj._lock) +
+                       sys.getsizeof(fileobj._readers)
+                       for fileobj in fileobjs) / float(files)
+        with session:
+            opened = open("/memfile/0.log")
+            per_open = _object_bytes(opened) + _object_bytes(opened._content)
+            opened.close()
+        yield 'footprint', {'files': files}, {
+            'bytes_per_file': per_file, 'bytes_per_open': per_open}
+
+def bench_session(sizes, number):
+    for files in sizes:
+        session = _session(files, 0)
+
+        def enter_exit():
+            with session:
+                pass
+
+        yield 'session', {'files': files}, {'us': _per_call(enter_exit,
+                                                             number)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--quick', action='store_true',
+                        help="smaller sizes and fewer iterations")
+    parser.add_argument('--output', help="append results to this file")
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        sizes, number, appends = (1, 100), 200, (100, 1000)
+    else:
+        sizes, number, appends = (1, 100, 10000), 2000, (1000, 10000, 50000)
+
+    dirpath = _tmpfs_dir()
+    output = io.open(args.output, 'a') if args.output else None
+    common = {'python': platform.python_version(),
+              'implementation': platform.python_implementation()}
+    try:
+        _real_files(dirpath, 1)
+        benchmarks = [bench_open(dirpath, sizes, number),
+                      bench_read(dirpath, max(number // 20, 10)),
+                      bench_append(dirpath, appends, number),
+                      bench_mappings(sizes, number),
+                      bench_footprint(sizes),
+                      bench_session(sizes, number)]
+        for benchmark in benchmarks:
+            for name, params, results in benchmark:
+                record = dict(common, benchmark=name, params=params,
+                              results=results)
+                line = json.dumps(record, sort_keys=True)
+                print(line)
+                sys.stdout.flush()
+                if output is not None:
+                    output.write(line + "\n")
+    finally:
+        if output is not None:
+            output.close()
+        shutil.rmtree(dirpath)
+
+if __name__ == '__main__':
+    main()
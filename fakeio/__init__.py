@@ -6,22 +6,374 @@ import logging
 import StringIO
 import os
 import io
+import re
+import shutil
+import sys
+import bisect
+import bz2
+import errno
+import fnmatch
+import tempfile
+import threading
+import collections
+import tarfile
+import zipfile
+import itertools
+import gc
+import json
+import mmap
+import struct
+import stat
+import time
+import weakref
+import zlib
+import sre_constants
+import sre_parse
 
 LOGGER = logging.getLogger(__name__)
 
+# Loaders read real files even while a session replaces open.
+_real_open = __builtin__.open
+_real_stat = os.stat
+_real_os_open = os.open
+_real_os_close = os.close
+_real_fstat = os.fstat
+_real_listdir = os.listdir
+
 _FILE_ATTRS = ['__iter__', 'close', 'flush', 'isatty', 'len', 'next', 'pos',
                'read', 'readline', 'readlines', 'seek', 'tell', 'truncate',
                'write', 'writelines']
+_FILE_PROPERTIES = ['len', 'pos']
+
+def _delegating(cls):
+    # Gives an opened file class the attributes of _FILE_ATTRS it does not
+    # define itself, forwarding them to its _content. Doing this once on the
+    # class keeps opening a file from binding every method of the content.
+    def delegate(name):
+        if name in _FILE_PROPERTIES:
+            return property(lambda self: getattr(self._content, name))
+
+        def method(self, *args):
+            return getattr(self._content, name)(*args)
+        method.__name__ = str(name)
+        return method
+
+    for name in _FILE_ATTRS:
+        if not hasattr(cls, name):
+            setattr(cls, str(name), delegate(name))
+    return cls
 
 class ProgrammingException(Exception):
     pass
 
+class _Reader(object):
+    # What the read-only cursors below have in common.
+
+    __slots__ = ('_pos', 'closed')
+
+    softspace = 0
+
+    @property
+    def pos(self):
+        return self._pos
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def readlines(self, hint=-1):
+        lines = []
+        total = 0
+        for line in self:
+            lines.append(line)
+            total += len(line)
+            if hint is not None and 0 < hint <= total:
+                break
+        return lines
+
+    def tell(self):
+        self._check_closed()
+        return self._pos
+
+    def flush(self):
+        self._check_closed()
+
+    def isatty(self):
+        self._check_closed()
+        return False
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def write(self, s):
+        raise io.UnsupportedOperation("File not open for writing")
+
+    def writelines(self, lines):
+        raise io.UnsupportedOperation("File not open for writing")
+
+    def truncate(self, size=None):
+        raise io.UnsupportedOperation("File not open for writing")
+
+    def fileno(self):
+        raise io.UnsupportedOperation("fileno")
+
+    def detach(self):
+        raise io.UnsupportedOperation("detach")
+
+    def _check_closed(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+
+class _SharedReader(_Reader):
+    # Read-only cursor over content that is shared by every reader of a
+    # file. The content is never copied; each reader only keeps a position.
+
+    __slots__ = ('_content', '_newline')
+
+    def __init__(self, content):
+        self._content = content
+        # Searching str for a unicode newline decodes the whole content.
+        self._newline = '\n' if isinstance(content, unicode) else b'\n'
+        self._pos = 0
+        self.closed = False
+
+    @property
+    def len(self):
+        return len(self._content)
+
+    def read(self, n=-1):
+        self._check_closed()
+        pos = self._pos
+        if n is None or n < 0:
+            end = len(self._content)
+        else:
+            end = min(pos + n, len(self._content))
+        self._pos = max(pos, end)
+        return self._content[pos:end]
+
+    def readline(self, limit=-1):
+        self._check_closed()
+        pos = self._pos
+        end = self._content.find(self._newline, pos)
+        if end < 0:
+            end = len(self._content)
+        else:
+            end += 1
+        if limit is not None and limit >= 0:
+            end = min(end, pos + limit)
+        self._pos = max(pos, end)
+        return self._content[pos:end]
+
+    def read1(self, n=-1):
+        return self.read(n)
+
+    def readinto(self, b):
+        self._check_closed()
+        pos = self._pos
+        end = min(pos + len(b), len(self._content))
+        if end <= pos:
+            return 0
+        try:
+            memoryview(b)[:end - pos] = memoryview(self._content)[pos:end]
+        except TypeError:
+            # Buffers without the new buffer protocol, like array.array.
+            b[:end - pos] = self._content[pos:end]
+        self._pos = end
+        return end - pos
+
+    def getbuffer(self):
+        self._check_closed()
+        return memoryview(self._content)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._check_closed()
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._content)
+        self._pos = max(0, offset)
+        return self._pos
+
+    def getvalue(self):
+        self._check_closed()
+        return self._content
+
+    def close(self):
+        self.closed = True
+
+    def seekable(self):
+        return True
+
+class _StreamReader(_Reader):
+    # Read-only cursor over a _StreamContent. It only keeps the chunks being
+    # read, so reading sequentially takes memory independent of the file
+    # size. Seeking backwards starts reading the stream over.
+
+    __slots__ = ('_stream', '_convert', '_empty', '_newline', '_chunks',
+                 '_buffer', '_offset')
+
+    def __init__(self, stream, convert):
+        self._stream = stream
+        self._convert = convert
+        self._empty = b''
+        self._newline = b'\n'
+        self._chunks = convert(stream.chunks())
+        self._buffer = b''
+        self._offset = 0
+        self._pos = 0
+        self.closed = False
+
+    @property
+    def len(self):
+        return self._stream.length
+
+    def _fill(self, enough):
+        # Joins what is left of the buffer with the next chunks, up to the
+        # first one for which enough(chunk, size) holds, in one go so that
+        # reading many small chunks stays linear.
+        parts = [self._buffer[self._offset:]]
+        size = len(parts[0])
+        for chunk in self._chunks:
+            if chunk:
+                parts.append(chunk)
+                size += len(chunk)
+                if enough(chunk, size):
+                    break
+        self._buffer = self._empty.join(parts)
+        self._offset = 0
+
+    def _take(self, end):
+        data = self._buffer[self._offset:end]
+        self._offset = end
+        self._pos += len(data)
+        return data
+
+    def read(self, n=-1):
+        self._check_closed()
+        if n is None or n < 0:
+            parts = [self._buffer[self._offset:]]
+            parts.extend(self._chunks)
+            data = self._empty.join(parts)
+            self._buffer = self._empty
+            self._offset = 0
+            self._pos += len(data)
+            return data
+        if len(self._buffer) - self._offset < n:
+            self._fill(lambda chunk, size: size >= n)
+        return self._take(self._offset + n)
+
+    def read1(self, n=-1):
+        self._check_closed()
+        if self._offset == len(self._buffer):
+            self._fill(lambda chunk, size: True)
+        if n is None or n < 0:
+            return self._take(len(self._buffer))
+        return self._take(self._offset + n)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def readline(self, limit=-1):
+        self._check_closed()
+        if limit is None or limit < 0:
+            limit = None
+        newline = self._newline
+        end = self._buffer.find(newline, self._offset)
+        if end < 0 and (limit is None or
+                        len(self._buffer) - self._offset < limit):
+            self._fill(lambda chunk, size: newline in chunk or
+                       (limit is not None and size >= limit))
+            end = self._buffer.find(newline)
+        if end < 0:
+            end = len(self._buffer)
+        else:
+            end += 1
+        if limit is not None:
+            end = min(end, self._offset + limit)
+        return self._take(end)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._check_closed()
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            self.read()
+            offset += self._pos
+        offset = max(0, offset)
+        if offset < self._pos:
+            self._chunks = self._convert(self._stream.chunks())
+            self._buffer = self._empty
+            self._offset = 0
+            self._pos = 0
+        while self._pos < offset and self.read(min(offset - self._pos,
+                                                   1 << 20)):
+            pass
+        return self._pos
+
+    def close(self):
+        self.closed = True
+        self._buffer = self._empty
+        self._chunks = iter(())
+
+    def seekable(self):
+        return self._stream.reloadable
+
+class _DecodingReader(io.TextIOWrapper):
+    # Decodes bytes as they are read. A read of the whole content from the
+    # start hands the text to the file, so that the next readers need no
+    # decoding, unless errors were replaced or newlines translated.
+
+    def __init__(self, file, version, content, encoding, errors, newline):
+        super(_DecodingReader, self).__init__(_SharedReader(content),
+                                              encoding, errors, newline)
+        self._file = file
+        self._version = version
+        self._strict = errors in (None, 'strict')
+        self._translating = newline not in ('', '\n')
+
+    def read(self, n=-1):
+        whole = (n is None or n < 0) and self.buffer.tell() == 0
+        text = super(_DecodingReader, self).read(n)
+        if whole and self._strict and (not self._translating or
+                                       self.newlines in (None, '\n')):
+            self._file._cache_decoded(self._version, text)
+        return text
+
+def _encode_chunks(chunks, encoding):
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode(encoding or 'utf8')
+        yield chunk
+
+def _open_reader_content(content):
+    if isinstance(content, (_StreamReader, io.IOBase)):
+        return content
+    return _SharedReader(content)
+
 class FakeTextIOFile(object):
 
-    def __init__(self, filepath, content, file):
+    __slots__ = ('_filepath', '_content', '_file', '_descriptor')
+
+    def __init__(self, filepath, content, file, writable=True):
         self._filepath = filepath
-        self._content = io.StringIO(content)
+        if isinstance(content, io.IOBase):
+            self._content = content
+        elif writable:
+            self._content = io.StringIO(content)
+        else:
+            self._content = _open_reader_content(content)
         self._file = file
+        self._descriptor = None
 
     # FileIO
 
@@ -61,9 +413,32 @@ class FakeTextIOFile(object):
 
     # IOBase
 
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self._content.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def close(self):
-        self._file._close(self)
-        self._file._sync_content(self._content.getvalue())
+        content = None
+        if self._content.writable():
+            if isinstance(self._content, io.TextIOWrapper):
+                self._content.flush()
+                content = self._content.buffer.getvalue()
+                if self._file._encoding is None:
+                    content = content.decode('utf8')
+            else:
+                content = self._content.getvalue()
+        self._file._close(self, content)
         self._content.close()
 
     @property
@@ -103,18 +478,72 @@ class FakeTextIOFile(object):
     def writelines(self, lines):
         return self._content.writelines(lines)
 
+class FakeBinaryIOFile(FakeTextIOFile):
+    # Returned by io.open in binary mode. Readers share the bytes of the file,
+    # so that readinto copies straight from them into the caller's buffer.
+
+    __slots__ = ()
+
+    def __init__(self, filepath, content, file, writable=True):
+        self._filepath = filepath
+        if writable:
+            self._content = io.BytesIO(content)
+        else:
+            self._content = _open_reader_content(content)
+        self._file = file
+        self._descriptor = None
+
+    # BufferedIOBase
+
+    def read1(self, n=-1):
+        return self._content.read1(n)
+
+    def readinto(self, b):
+        return self._content.readinto(b)
+
+    def getbuffer(self):
+        # io.BytesIO has no getbuffer before Python 3.2; writers give a read
+        # only view of what has been written so far.
+        if isinstance(self._content, _SharedReader):
+            return self._content.getbuffer()
+        return memoryview(self._content.getvalue())
+
+    def close(self):
+        super(FakeBinaryIOFile, self).close()
+        if self._descriptor is not None:
+            self._descriptor.close()
+            self._descriptor = None
+
+    def fileno(self):
+        # Readers hand out a descriptor of a read only copy, for mmap
+        if self._content.writable():
+            return self._content.fileno()
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if self._descriptor is None:
+            self._descriptor = self._file._open_descriptor(os.O_RDONLY)
+        return self._descriptor.fd
+
+@_delegating
 class ReadOpenedFakeIOFile(object):
+    __slots__ = ('_filepath', '_content', '_file', '_descriptor')
+
     def __init__(self, filepath, content, file):
         self._filepath = filepath
-        self._content = StringIO.StringIO(content)
+        self._content = _open_reader_content(content)
         self._file = file
-        for attr in _FILE_ATTRS:
-            if not hasattr(self, attr):
-                setattr(self, attr, getattr(self._content, attr))
+        self._descriptor = None
 
     def __iter__(self):
         return self._content.__iter__()
 
+    # Spelled out as the calls most often made in loops
+    def read(self, n=-1):
+        return self._content.read(n)
+
+    def readline(self, limit=-1):
+        return self._content.readline(limit)
+
     @property
     def name(self):
         return self._filepath
@@ -130,6 +559,17 @@ class ReadOpenedFakeIOFile(object):
     def close(self):
         self._file._close(self)
         self._content.close()
+        if self._descriptor is not None:
+            self._descriptor.close()
+            self._descriptor = None
+
+    def fileno(self):
+        # A descriptor of a read only copy, for mmap and the like
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if self._descriptor is None:
+            self._descriptor = self._file._open_descriptor(os.O_RDONLY)
+        return self._descriptor.fd
 
     def __enter__(self):
         return self
@@ -137,16 +577,151 @@ class ReadOpenedFakeIOFile(object):
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
+class _Rope(object):
+    # Immutable content made of the content it extends and the chunks that
+    # were appended to it. Nothing is copied until the content is joined.
+
+    def __init__(self, base, chunks):
+        self.base = base
+        self.chunks = chunks
+        self.length = len(base) + sum(len(chunk) for chunk in chunks)
+        self.nbytes = _sizeof(base) + sum(sys.getsizeof(chunk)
+                                          for chunk in chunks)
+
+    def __len__(self):
+        return self.length
+
+    def join(self):
+        parts = []
+        node = self
+        while isinstance(node, _Rope):
+            parts.extend(reversed(node.chunks))
+            node = node.base
+        parts.append(node)
+        parts.reverse()
+        return b''.join(parts)
+
+class _ChunkedWriter(object):
+    # Write buffer that collects writes at the end of the content as chunks
+    # without copying the content it was opened with. Anything else, like
+    # reading or writing in the middle, falls back to a StringIO holding the
+    # joined content.
+
+    __slots__ = ('_base', '_chunks', '_size', '_pos', '_buffer', 'closed')
+
+    softspace = 0
+
+    def __init__(self, base):
+        self._base = base
+        self._chunks = []
+        self._size = len(base)
+        self._pos = 0
+        self._buffer = None
+        self.closed = False
+
+    @property
+    def len(self):
+        if self._buffer is not None:
+            return self._buffer.len
+        return self._size
+
+    @property
+    def pos(self):
+        if self._buffer is not None:
+            return self._buffer.pos
+        return self._pos
+
+    def __iter__(self):
+        return self._materialize().__iter__()
+
+    def next(self):
+        return self._materialize().next()
+
+    def write(self, s):
+        if self._buffer is None and self._pos == self._size:
+            self._check_closed()
+            if s:
+                self._chunks.append(s)
+                self._size += len(s)
+                self._pos = self._size
+            return
+        self._materialize().write(s)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if self._buffer is not None:
+            return self._buffer.seek(offset, whence)
+        self._check_closed()
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            offset += self._size
+        self._pos = max(0, offset)
+
+    def tell(self):
+        if self._buffer is not None:
+            return self._buffer.tell()
+        self._check_closed()
+        return self._pos
+
+    def read(self, n=-1):
+        return self._materialize().read(n)
+
+    def readline(self, length=None):
+        return self._materialize().readline(length)
+
+    def readlines(self, sizehint=0):
+        return self._materialize().readlines(sizehint)
+
+    def truncate(self, size=None):
+        return self._materialize().truncate(size)
+
+    def flush(self):
+        self._check_closed()
+
+    def isatty(self):
+        self._check_closed()
+        return False
+
+    def content(self):
+        if self._buffer is not None:
+            return self._buffer.getvalue()
+        if not self._chunks:
+            return self._base
+        return _Rope(self._base, tuple(self._chunks))
+
+    def close(self):
+        self.closed = True
+        if self._buffer is not None:
+            self._buffer.close()
+
+    def _materialize(self):
+        if self._buffer is None:
+            self._check_closed()
+            content = self.content()
+            if isinstance(content, _Rope):
+                content = content.join()
+            self._buffer = StringIO.StringIO(content)
+            self._buffer.seek(self._pos)
+            self._base = None
+            self._chunks = None
+        return self._buffer
+
+    def _check_closed(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+
+@_delegating
 class WriteOpenedFakeIOFile(object):
+    __slots__ = ('_filepath', '_content', '_file')
+
     def __init__(self, filepath, content, file):
         self._filepath = filepath
-        self._content = StringIO.StringIO()
-        self._content.write(content)
-        self._content.seek(0)
+        self._content = _ChunkedWriter(content)
         self._file = file
-        for attr in _FILE_ATTRS:
-            if not hasattr(self, attr):
-                setattr(self, attr, getattr(self._content, attr))
 
     def __iter__(self):
         return self._content.__iter__()
@@ -164,8 +739,7 @@ class WriteOpenedFakeIOFile(object):
         return self._content.softspace
 
     def close(self):
-        self._file._close(self)
-        self._file._sync_content(self._content.getvalue())
+        self._file._close(self, self._content.content())
         self._content.close()
 
     def __enter__(self):
@@ -174,139 +748,2583 @@ class WriteOpenedFakeIOFile(object):
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
+class _FileStats(object):
+    # I/O counters of one fake file. Files only have them while their session
+    # collects statistics, and only then are handles opened with the counting
+    # classes below, so that nothing is counted otherwise.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.opens = 0
+        self.reads = 0
+        self.bytes_read = 0
+        self.writes = 0
+        self.bytes_written = 0
+        self.write_sizes = collections.Counter()
+        self.open_seconds = 0.0
+
+    def record_open(self):
+        with self._lock:
+            self.opens += 1
+
+    def record_close(self, seconds):
+        with self._lock:
+            self.open_seconds += seconds
+
+    def record_read(self, size):
+        with self._lock:
+            self.reads += 1
+            self.bytes_read += size
+
+    def record_write(self, size):
+        with self._lock:
+            self.writes += 1
+            self.bytes_written += size
+            # Sizes are counted in power of two buckets, keyed by the upper
+            # bound of the bucket.
+            self.write_sizes[1 << (size - 1).bit_length() if size else 0] += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'opens': self.opens,
+                'reads': self.reads,
+                'bytes_read': self.bytes_read,
+                'writes': self.writes,
+                'bytes_written': self.bytes_written,
+                'write_sizes': dict(self.write_sizes),
+                'open_seconds': self.open_seconds,
+                }
+
+def _merge_stats(total, stats):
+    for key, value in stats.iteritems():
+        if key == 'write_sizes':
+            sizes = total.setdefault(key, dict())
+            for size, count in value.iteritems():
+                sizes[size] = sizes.get(size, 0) + count
+        else:
+            total[key] = total.get(key, 0) + value
+    return total
+
+class StorageProfile(object):
+    # Simulated performance of the storage behind fake files. Latencies are
+    # in seconds and bandwidths in bytes (characters for text) per second.
+
+    def __init__(self, open_latency=0.0, call_latency=0.0,
+                 read_bandwidth=None, write_bandwidth=None):
+        self.open_latency = open_latency
+        self.call_latency = call_latency
+        self.read_bandwidth = read_bandwidth
+        self.write_bandwidth = write_bandwidth
+
+class VirtualClock(object):
+    # Time that only passes by sleeping, so that simulated latencies take no
+    # real time. Sessions may use any object with time() and sleep() instead,
+    # like the time module to really slow files down.
+
+    def __init__(self, start=0.0):
+        self._now = start
+        self._lock = threading.Lock()
+
+    def time(self):
+        return self._now
+
+    def sleep(self, seconds):
+        with self._lock:
+            self._now += seconds
+
+class _ProfileMonitor(object):
+    # Charges the costs of a StorageProfile to a clock.
+
+    def __init__(self, profile, clock):
+        self.profile = profile
+        self._clock = clock
+
+    def record_open(self):
+        if self.profile.open_latency:
+            self._clock.sleep(self.profile.open_latency)
+
+    def record_close(self, seconds):
+        pass
+
+    def record_read(self, size):
+        self._charge(size, self.profile.read_bandwidth)
+
+    def record_write(self, size):
+        self._charge(size, self.profile.write_bandwidth)
+
+    def _charge(self, size, bandwidth):
+        seconds = self.profile.call_latency
+        if bandwidth:
+            seconds += float(size) / bandwidth
+        if seconds:
+            self._clock.sleep(seconds)
+
+class _MonitoredFile(object):
+    # Mixed into the opened file classes, and reporting every call to the
+    # monitors of the file: its _FileStats and its _ProfileMonitor. All of
+    # the classes keep their buffer in _content. Its slots are declared by
+    # the classes it is mixed into, as only one base may have any.
+
+    __slots__ = ()
+
+    def __init__(self, filepath, content, file, *args, **kwargs):
+        self._monitors = file._monitors()
+        for monitor in self._monitors:
+            monitor.record_open()
+        super(_MonitoredFile, self).__init__(filepath, content, file,
+                                             *args, **kwargs)
+        self._opened_at = time.time()
+
+    def _record_read(self, size):
+        for monitor in self._monitors:
+            monitor.record_read(size)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def read(self, n=-1):
+        data = self._content.read(n)
+        self._record_read(len(data))
+        return data
+
+    def readline(self, limit=-1):
+        line = self._content.readline(limit)
+        self._record_read(len(line))
+        return line
+
+    def readlines(self, hint=-1):
+        lines = self._content.readlines(hint)
+        self._record_read(sum(len(line) for line in lines))
+        return lines
+
+    def write(self, s):
+        result = self._content.write(s)
+        for monitor in self._monitors:
+            monitor.record_write(len(s))
+        return result
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def close(self):
+        if not self.closed:
+            seconds = time.time() - self._opened_at
+            for monitor in self._monitors:
+                monitor.record_close(seconds)
+        super(_MonitoredFile, self).close()
+
+class _MonitoredTextIOFile(_MonitoredFile, FakeTextIOFile):
+    __slots__ = ('_monitors', '_opened_at')
+
+class _MonitoredBinaryIOFile(_MonitoredFile, FakeBinaryIOFile):
+
+    __slots__ = ('_monitors', '_opened_at')
+
+    def read1(self, n=-1):
+        data = self._content.read1(n)
+        self._record_read(len(data))
+        return data
+
+    def readinto(self, b):
+        count = self._content.readinto(b)
+        self._record_read(count)
+        return count
+
+class _MonitoredReadOpenedFakeIOFile(_MonitoredFile, ReadOpenedFakeIOFile):
+    __slots__ = ('_monitors', '_opened_at')
+
+class _MonitoredWriteOpenedFakeIOFile(_MonitoredFile, WriteOpenedFakeIOFile):
+    __slots__ = ('_monitors', '_opened_at')
+
+class _SpillStore(object):
+    # Anonymous temporary file that holds the spilled contents of every file
+    # of a session. Released ranges are kept sorted and merged, reused by
+    # later contents that fit, and truncated away when they reach the end.
+
+    def __init__(self):
+        self._file = None
+        self._size = 0
+        self._free = []
+        self._lock = threading.Lock()
+        self.nbytes = 0
+
+    def put(self, data):
+        with self._lock:
+            if self._file is None:
+                # Not tempfile.TemporaryFile, which goes through os.open.
+                path = os.path.join(tempfile.gettempdir(),
+                                    'fakeio-spill-%d-%d' % (
+                                        os.getpid(), next(_SEGMENTS)))
+                fd = _real_os_open(
+                    path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+                os.unlink(path)
+                self._file = os.fdopen(fd, 'w+b')
+            offset = self._allocate(len(data))
+            self._file.seek(offset)
+            self._file.write(data)
+            self.nbytes += len(data)
+            return offset
+
+    def _allocate(self, length):
+        for i, (start, size) in enumerate(self._free):
+            if size >= length:
+                if size == length:
+                    del self._free[i]
+                else:
+                    self._free[i] = (start + length, size - length)
+                return start
+        offset = self._size
+        self._size += length
+        return offset
+
+    def get(self, offset, length):
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(length)
+
+    def release(self, offset, length):
+        with self._lock:
+            self.nbytes -= length
+            if not length:
+                return
+            free = self._free
+            i = bisect.bisect(free, (offset, length))
+            free.insert(i, (offset, length))
+            if i + 1 < len(free) and offset + length == free[i + 1][0]:
+                free[i] = (offset, length + free.pop(i + 1)[1])
+            if i and free[i - 1][0] + free[i - 1][1] == offset:
+                free[i - 1] = (free[i - 1][0], free[i - 1][1] + free.pop(i)[1])
+            start, size = free[-1]
+            if start + size == self._size:
+                free.pop()
+                self._size = start
+                self._file.truncate(start)
+
+class _DeferredContent(object):
+    # Content that is not in memory and is loaded when a file is opened.
+    # Reloadable content can be dropped again instead of being spilled.
+    # The length is in bytes and known without loading the content.
+
+    reloadable = False
+    length = 0
+
+    def load(self):
+        raise NotImplementedError
+
+    def retain(self):
+        pass
+
+    def release(self):
+        pass
+
+class _DiskContent(_DeferredContent):
+    reloadable = True
+
+    def __init__(self, path):
+        self._path = path
+
+    @property
+    def length(self):
+        return _real_stat(self._path).st_size
+
+    def load(self):
+        with _real_open(self._path, 'rb') as fileobj:
+            return fileobj.read()
+
+class _ArchiveContent(_DeferredContent):
+    reloadable = True
+
+    def __init__(self, archive, member, length, decode=None):
+        self._archive = archive
+        self._member = member
+        self.length = length
+        self._decode = decode
+
+    def load(self):
+        content = self._archive.read(self._member)
+        if self._decode is not None:
+            return content.decode(self._decode)
+        return content
+
+class _SharedContent(_DeferredContent):
+    # Content in a segment of a FakeIOShare, readable by every process. Text
+    # is stored encoded, and decoded again when loaded.
+    reloadable = True
+
+    def __init__(self, path, length, decode=None):
+        self._path = path
+        self.length = length
+        self.decode = decode
+
+    def load(self):
+        with _real_open(self._path, 'rb') as fileobj:
+            content = fileobj.read()
+        if self.decode is not None:
+            return content.decode(self.decode)
+        return content
+
+class _StreamContent(_DeferredContent):
+    # Content produced in chunks, by a callable returning a string or an
+    # iterable of chunks, or by an iterable itself. Readers pull the chunks
+    # as they read. Only callables can be read more than once, unless the
+    # chunks are cached as they are pulled.
+
+    def __init__(self, provider, cache=False, length=None):
+        self._provider = provider
+        self._cache = [] if cache else None
+        self._source = None
+        self._lock = threading.Lock()
+        self._length = length
+        self.reloadable = cache or callable(provider)
+
+    @property
+    def length(self):
+        # Unless given, found by pulling every chunk. Chunks that can only be
+        # pulled once are cached for that, if no reader has pulled any yet.
+        if self._length is None:
+            with self._lock:
+                if self._cache is None and not callable(self._provider):
+                    if self._source is not None:
+                        raise IOError("Length of stream content is unknown")
+                    self._cache = []
+                    self.reloadable = True
+            self._length = sum(len(chunk) for chunk in
+                               _encode_chunks(self.chunks(), None))
+        return self._length
+
+    def chunks(self):
+        if self._cache is not None:
+            return self._cached_chunks()
+        if callable(self._provider):
+            return self._call()
+        with self._lock:
+            if self._source is not None:
+                raise IOError("Stream content has already been read")
+            self._source = iter(self._provider)
+            return self._source
+
+    def _call(self):
+        chunks = self._provider()
+        if isinstance(chunks, basestring):
+            return iter([chunks])
+        return iter(chunks)
+
+    def _cached_chunks(self):
+        for i in itertools.count():
+            with self._lock:
+                if i == len(self._cache):
+                    if self._source is None:
+                        self._source = self._call() \
+                            if callable(self._provider) \
+                            else iter(self._provider)
+                    chunk = next(self._source, None)
+                    if chunk is None:
+                        return
+                    self._cache.append(chunk)
+                chunk = self._cache[i]
+            yield chunk
+
+    def load(self):
+        chunks = list(self.chunks())
+        if chunks and isinstance(chunks[0], unicode):
+            return ''.join(chunks)
+        return b''.join(chunks)
+
+class _TarArchive(object):
+    # The members are listed once, and the archive is opened again for every
+    # read, so that a mount keeps no descriptor open.
+
+    def __init__(self, path):
+        self._path = path
+        with _real_open(path, 'rb') as fileobj:
+            self._members = tarfile.open(fileobj=fileobj).getmembers()
+
+    def members(self):
+        return [(member.name, member, member.size)
+                for member in self._members if member.isfile()]
+
+    def read(self, member):
+        with _real_open(self._path, 'rb') as fileobj:
+            return tarfile.open(fileobj=fileobj).extractfile(member).read()
+
+class _ZipArchive(object):
+    # Same as _TarArchive. The index is kept in a ZipFile that is only given
+    # an open file while it reads a member.
+
+    def __init__(self, path):
+        self._path = path
+        with _real_open(path, 'rb') as fileobj:
+            self._zipfile = zipfile.ZipFile(fileobj)
+        self._zipfile.fp = None
+        self._lock = threading.Lock()
+
+    def members(self):
+        return [(info.filename, info, info.file_size)
+                for info in self._zipfile.infolist()
+                if not info.filename.endswith('/')]
+
+    def read(self, member):
+        with self._lock, _real_open(self._path, 'rb') as fileobj:
+            self._zipfile.fp = fileobj
+            try:
+                return self._zipfile.read(member)
+            finally:
+                self._zipfile.fp = None
+
+# Session images start with a header of the magic, the number of files and
+# the byte lengths of the paths and of the kinds, which are followed by the
+# offset, length and kind of every file, the paths separated by NUL, the
+# kinds as JSON list of [mode, encoding, decode] and finally the contents.
+# Decode is the encoding of contents that were text, or null.
+_IMAGE_MAGIC = b'FAKEIO\x00\x02'
+_IMAGE_HEADER = struct.Struct(b'<8sQQQ')
+
+class _Image(object):
+    def __init__(self, path):
+        with _real_open(path, 'rb') as fileobj:
+            self._mmap = mmap.mmap(fileobj.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+        if self._mmap.size() < _IMAGE_HEADER.size or \
+                self._mmap[:len(_IMAGE_MAGIC)] != _IMAGE_MAGIC:
+            raise ValueError("%s is not a session image" % path)
+
+    def members(self):
+        # Only the index is read here, however large the contents are.
+        _, count, paths_length, kinds_length = \
+            _IMAGE_HEADER.unpack_from(self._mmap)
+        pos = _IMAGE_HEADER.size
+        entries = struct.unpack_from(b'<%dQ' % (3 * count), self._mmap, pos)
+        pos += 24 * count
+        paths = self._mmap[pos:pos + paths_length].decode('utf8').split('\0')
+        pos += paths_length
+        kinds = json.loads(self._mmap[pos:pos + kinds_length])
+        return [(paths[i], kinds[entries[3 * i + 2]],
+                 (entries[3 * i], entries[3 * i + 1]), entries[3 * i + 1])
+                for i in xrange(count)]
+
+    def read(self, member):
+        offset, length = member
+        return self._mmap[offset:offset + length]
+
+def _write_image(path, entries):
+    # entries are (path, mode, encoding, decode, encoded content).
+    kinds = dict()
+    for _, mode, encoding, decode, _ in entries:
+        kinds.setdefault((mode, encoding, decode), len(kinds))
+    paths = '\0'.join(entry[0] for entry in entries).encode('utf8')
+    kinds_json = json.dumps([list(kind) for kind, _ in
+                             sorted(kinds.iteritems(), key=lambda x: x[1])])
+    kinds_json = kinds_json.encode('utf8')
+    offset = _IMAGE_HEADER.size + 24 * len(entries) + len(paths) + \
+        len(kinds_json)
+    numbers = []
+    for _, mode, encoding, decode, content in entries:
+        numbers.extend((offset, len(content), kinds[(mode, encoding, decode)]))
+        offset += len(content)
+    with _real_open(path, 'wb') as fileobj:
+        fileobj.write(_IMAGE_HEADER.pack(_IMAGE_MAGIC, len(entries),
+                                         len(paths), len(kinds_json)))
+        fileobj.write(struct.pack(b'<%dQ' % len(numbers), *numbers))
+        fileobj.write(paths)
+        fileobj.write(kinds_json)
+        for entry in entries:
+            fileobj.write(entry[4])
+
+class _SpilledContent(_DeferredContent):
+    # Content that was moved out of memory into a _SpillStore. Snapshots may
+    # share it with the file, so its space is released by reference count.
+
+    def __init__(self, store, content):
+        self._store = store
+        self._text = isinstance(content, unicode)
+        if self._text:
+            content = content.encode('utf8')
+        self.length = len(content)
+        self._offset = store.put(content)
+        self._refs = 1
+
+    def load(self):
+        content = self._store.get(self._offset, self.length)
+        if self._text:
+            return content.decode('utf8')
+        return content
+
+    def retain(self):
+        self._refs += 1
+
+    def release(self):
+        self._refs -= 1
+        if not self._refs:
+            self._store.release(self._offset, self.length)
+
+# Compression of cold contents: a fast zlib level, or bz2 for smaller output.
+_COMPRESSORS = {
+    'zlib': (lambda data: zlib.compress(data, 1), zlib.decompress),
+    'bz2': (bz2.compress, bz2.decompress),
+    }
+# Contents shorter than this are not worth compressing.
+_COMPRESS_MIN_SIZE = 512
+
+class _CompressedContent(_DeferredContent):
+    # Content of an idle file compressed in memory. It never changes, so
+    # snapshots can share it without counting references.
+
+    def __init__(self, content, compression):
+        self._text = isinstance(content, unicode)
+        if self._text:
+            content = content.encode('utf8')
+        self.length = len(content)
+        compress, self._decompress = _COMPRESSORS[compression]
+        self._data = compress(content)
+
+    @property
+    def nbytes(self):
+        return len(self._data)
+
+    def load(self):
+        content = self._decompress(self._data)
+        if self._text:
+            return content.decode('utf8')
+        return content
+
+def _tmpfs_dir():
+    try:
+        if stat.S_ISDIR(_real_stat('/dev/shm').st_mode):
+            return '/dev/shm'
+    except OSError:
+        pass
+    return tempfile.gettempdir()
+
+_ACCESS_FLAGS = os.O_RDONLY | os.O_WRONLY | os.O_RDWR
+
+class _Descriptor(object):
+    # A real descriptor of a copy of a fake file on tmpfs, for fd and mmap
+    # based readers. The copy is unlinked at once; a writable copy is read
+    # back into the file when the descriptor is closed, through a second
+    # descriptor since the first may be write only.
+
+    def __init__(self, file, content, flags, decode=None):
+        self._file = file
+        self._decode = decode
+        self._session = None
+        self._lock = threading.Lock()
+        self._closed = False
+        self.writable = bool(flags & (os.O_WRONLY | os.O_RDWR))
+        path = os.path.join(_tmpfs_dir(), 'fakeio-fd-%d-%d' % (
+            os.getpid(), next(_SEGMENTS)))
+        backing = _real_os_open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL,
+                                0o600)
+        try:
+            view = memoryview(content)
+            while view:
+                view = view[os.write(backing, view):]
+            self.fd = _real_os_open(
+                path, flags & (_ACCESS_FLAGS | os.O_APPEND))
+        except:
+            _real_os_close(backing)
+            raise
+        finally:
+            os.unlink(path)
+        result = _real_fstat(self.fd)
+        self._identity = (result.st_dev, result.st_ino)
+        if self.writable:
+            self._backing = backing
+        else:
+            self._backing = None
+            _real_os_close(backing)
+
+    def stale(self):
+        # Closed without os.close, as by os.fdopen or io.open, which may
+        # also have let another file take its number.
+        try:
+            result = _real_fstat(self.fd)
+        except OSError:
+            return True
+        return (result.st_dev, result.st_ino) != self._identity
+
+    def close(self):
+        self._finish(not self.stale())
+
+    def release(self):
+        # For a descriptor closed elsewhere: its writes are kept all the same.
+        self._finish(False)
+
+    def _finish(self, close_fd):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        content = None
+        try:
+            if self._backing is not None:
+                os.lseek(self._backing, 0, os.SEEK_SET)
+                chunks = []
+                while True:
+                    chunk = os.read(self._backing, 1 << 20)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                content = b''.join(chunks)
+                if self._decode is not None:
+                    content = content.decode(self._decode)
+                _real_os_close(self._backing)
+        finally:
+            if close_fd:
+                _real_os_close(self.fd)
+            if self._session is not None:
+                self._session._forget_descriptor(self)
+        self._file._close(self, content)
+
+_VERSIONS = itertools.count(1)
+
 class FakeIOFile(object):
+    __slots__ = ('_filepath', '_mode', '_content', '_encoding', '_writer',
+                 '_readers', '_encoded', '_decoded', '_memory', '_owner',
+                 '_lock', '_version', '_origin', '_mtime', '_stats',
+                 '_profile')
+
     def __init__(self, filepath, mode, content, encoding=None):
         self._filepath = filepath
         self._mode = mode
         self._content = content
         self._encoding = encoding
-        self._open_file = None
+        self._writer = None
+        self._readers = []
+        self._encoded = None
+        self._decoded = None
+        self._memory = 0
+        self._owner = None
+        self._lock = threading.Lock()
+        self._version = next(_VERSIONS)
+        self._origin = None
+        self._mtime = time.time()
+        self._stats = None
+        self._profile = None
 
     def open(self, mode):
-        if isinstance(self._content, unicode):
-            if self._encoding:
-                content = self._content.encode(self._encoding)
+        self._reap()
+        with self._lock:
+            return self._open(mode)
+
+    def io_open(self, mode, encoding=None, errors=None, newline=None):
+        self._reap()
+        with self._lock:
+            return self._io_open(mode, encoding, errors, newline)
+
+    def _open(self, mode):
+        if self._stats is None and self._profile is None:
+            reader_class = ReadOpenedFakeIOFile
+            writer_class = WriteOpenedFakeIOFile
+        else:
+            reader_class = _MonitoredReadOpenedFakeIOFile
+            writer_class = _MonitoredWriteOpenedFakeIOFile
+        if mode.startswith('r') and '+' not in mode:
+            return self._open_reader(reader_class(
+                self._filepath, self._reader_content(), self))
+        elif mode.startswith('r'):
+            self._check_writable()
+            return self._open_writer(
+                writer_class(self._filepath, self._encoded_content(), self))
+        elif mode.startswith('w'):
+            self._check_writable()
+            return self._open_writer(
+                writer_class(self._filepath, b'', self))
+        elif mode.startswith('a'):
+            self._check_writable()
+            if isinstance(self._content, _Rope):
+                # Appending to appended content keeps extending the rope
+                # instead of joining it.
+                content = self._content
             else:
-                content = self._content.encode('utf8')
-        elif isinstance(self._content, str):
-            if self._encoding:
-                # Check the encoding is valid
-                self._content.decode(self._encoding)
-            content = self._content
-        elif self._content is None:
-            content = ''
-
-        if mode.startswith('r'):
-            if self._open_file != None:
-                raise IOError("File can be simultaneously opened by only one")
-            self._open_file = ReadOpenedFakeIOFile(self._filepath,
-                                                   content, self)
-            return self._open_file
-        elif mode.startswith('w') or mode.startswith('a'):
-            if self._open_file != None:
-                raise IOError("File can be simultaneously opened by only one")
-            if self._mode != 'rw':
-                raise ValueError("File open mode is not consistent")
-            self._open_file = WriteOpenedFakeIOFile(self._filepath,
-                                                    content, self)
-            if mode.startswith('a'):
-                self._open_file.seek(0, os.SEEK_END)
-            return self._open_file
+                content = self._encoded_content()
+            writer = self._open_writer(
+                writer_class(self._filepath, content, self))
+            writer.seek(0, os.SEEK_END)
+            return writer
         else:
             raise ValueError("File open mode cannot be parsed")
 
-    def io_open(self, mode, encoding):
-        if isinstance(self._content, unicode):
-            content = self._content
-        elif isinstance(self._content, str):
-            if self._encoding:
-                content = self._content.decode(self._encoding)
+    def _io_open(self, mode, encoding, errors=None, newline=None):
+        if 'b' in mode:
+            return self._io_open_binary(mode)
+        if self._stats is None and self._profile is None:
+            text_class = FakeTextIOFile
+        else:
+            text_class = _MonitoredTextIOFile
+
+        if mode.startswith('r') and '+' not in mode:
+            return self._open_reader(text_class(
+                self._filepath,
+                self._text_reader_content(errors, newline), self,
+                writable=False))
+        if not mode.startswith(('r', 'w', 'a')):
+            raise ValueError("File open mode cannot be parsed")
+        self._check_writable()
+        return self._open_writer(text_class(
+            self._filepath,
+            self._text_writer_content(mode, errors, newline), self))
+
+    def _io_open_binary(self, mode):
+        if self._stats is None and self._profile is None:
+            binary_class = FakeBinaryIOFile
+        else:
+            binary_class = _MonitoredBinaryIOFile
+
+        if mode.startswith('r') and '+' not in mode:
+            return self._open_reader(binary_class(
+                self._filepath, self._reader_content(), self,
+                writable=False))
+        elif mode.startswith('r') or mode.startswith('a'):
+            self._check_writable()
+            writer = self._open_writer(
+                binary_class(self._filepath, self._encoded_content(), self))
+            if mode.startswith('a'):
+                writer.seek(0, io.SEEK_END)
+            return writer
+        elif mode.startswith('w'):
+            self._check_writable()
+            return self._open_writer(binary_class(self._filepath, b'', self))
+        raise ValueError("File open mode cannot be parsed")
+
+    def _reader_content(self):
+        # Streams are read while their chunks are pulled instead of being
+        # loaded when the file is opened.
+        if isinstance(self._content, _StreamContent):
+            encoding = self._encoding
+            return _StreamReader(
+                self._content,
+                lambda chunks: _encode_chunks(chunks, encoding))
+        return self._encoded_content()
+
+    def _text_reader_content(self, errors, newline):
+        # Text already decoded is shared; bytes are decoded as they are read,
+        # so reading the first line does not decode the whole file.
+        if isinstance(self._content, _StreamContent):
+            content = self._reader_content()
+        else:
+            content = self._resolve_content()
+            if self._decoded is not None or not isinstance(content, str):
+                content = self._decoded_content()
+                if newline == '\n' or (newline in (None, '') and
+                                       '\r' not in content):
+                    return content
+                # Newlines to translate; StringIO would do so for the ones
+                # it starts with, and could be written.
+                content, encoding = self._export_content()
+                return io.TextIOWrapper(_SharedReader(content),
+                                        encoding or 'ascii', errors, newline)
+            return _DecodingReader(self, self._version, content,
+                                   self._encoding or 'ascii', errors, newline)
+        return io.TextIOWrapper(content, self._encoding or 'ascii', errors,
+                                newline)
+
+    def _text_writer_content(self, mode, errors, newline):
+        # Files without an encoding keep text written to them as unicode,
+        # see FakeTextIOFile.close.
+        if mode.startswith('w'):
+            content = b''
+        else:
+            content, _ = self._export_content()
+        writer = io.TextIOWrapper(io.BytesIO(content),
+                                  self._encoding or 'utf8', errors, newline)
+        if mode.startswith('a'):
+            writer.seek(0, io.SEEK_END)
+        return writer
+
+    def _cache_decoded(self, version, text):
+        with self._lock:
+            if self._version == version and self._decoded is None and \
+                    isinstance(self._content, str):
+                self._decoded = text
+                self._touch()
+
+    def _check_writable(self):
+        if self._writer != None:
+            raise IOError("File can be simultaneously opened by only one "
+                          "writer")
+        if self._mode != 'rw':
+            raise ValueError("File open mode is not consistent")
+
+    def _open_descriptor(self, flags):
+        self._reap()
+        with self._lock:
+            if flags & (os.O_WRONLY | os.O_RDWR):
+                if self._mode != 'rw':
+                    raise OSError(errno.EACCES, os.strerror(errno.EACCES),
+                                  self._filepath)
+                if self._writer is not None:
+                    raise OSError(errno.EBUSY, os.strerror(errno.EBUSY),
+                                  self._filepath)
+                content, encoding = self._export_content()
+                if flags & os.O_TRUNC:
+                    content = b''
+                # Text without an encoding is stored back as text
+                decode = encoding if encoding != self._encoding else None
+                return self._open_writer(
+                    _Descriptor(self, content, flags, decode))
+            content, _ = self._export_content()
+            return self._open_reader(_Descriptor(self, content, flags))
+
+    def _reap(self):
+        # Descriptors closed without os.close are only noticed when the file
+        # is used again. Not under the lock, since closing publishes.
+        for open_file in [self._writer] + self._readers:
+            if isinstance(open_file, _Descriptor) and open_file.stale():
+                open_file.release()
+
+    def _open_reader(self, reader):
+        # Readers share the content they were opened with. A writer replaces
+        # the content on close instead of changing it, so readers opened
+        # before that keep seeing the old one.
+        self._readers.append(reader)
+        self._touch()
+        return reader
+
+    def _open_writer(self, writer):
+        self._writer = writer
+        self._touch()
+        return writer
+
+    def _resolve_content(self):
+        if isinstance(self._content, _Rope):
+            self._content = self._content.join()
+        elif isinstance(self._content, _DeferredContent):
+            deferred = self._content
+            self._content = deferred.load()
+            if deferred.reloadable:
+                self._origin = deferred
             else:
-                content = unicode(self._content)
-        elif self._content is None:
-            content = ''
-
-        if self._open_file != None:
-            raise IOError("File can be simultaneously opened by only one")
-        self._open_file = FakeTextIOFile(self._filepath, content, self)
-        return self._open_file
+                deferred.release()
+        return self._content
 
-    def _sync_content(self, content):
-        self._content = content
+    def _encoded_content(self):
+        # Both representations are kept until the content changes, so that
+        # opening an unchanged file does not transcode it again.
+        if self._encoded is None:
+            self._resolve_content()
+            if isinstance(self._content, unicode):
+                if self._encoding:
+                    self._encoded = self._content.encode(self._encoding)
+                else:
+                    self._encoded = self._content.encode('utf8')
+            elif isinstance(self._content, str):
+                if self._encoding:
+                    # Check the encoding is valid
+                    self._decoded = self._content.decode(self._encoding)
+                self._encoded = self._content
+            elif self._content is None:
+                self._encoded = b''
+        return self._encoded
+
+    def _decoded_content(self):
+        if self._decoded is None:
+            self._resolve_content()
+            if isinstance(self._content, unicode):
+                self._decoded = self._content
+            elif isinstance(self._content, str):
+                if self._encoding:
+                    self._decoded = self._content.decode(self._encoding)
+                else:
+                    self._decoded = unicode(self._content)
+            elif self._content is None:
+                self._decoded = ''
+        return self._decoded
+
+    def _state(self):
+        # Everything in the state is immutable, so snapshots and clones can
+        # share it with the file until the file is written again.
+        with self._lock:
+            if isinstance(self._content, _DeferredContent):
+                self._content.retain()
+            return (self._version,
+                    (self._content, self._encoded, self._decoded))
+
+    def _set_state(self, version, state):
+        with self._lock:
+            self._apply_state(version, state)
+
+    def _apply_state(self, version, state):
+        # The caller holds the lock of this file.
+        if isinstance(self._content, _DeferredContent):
+            self._content.release()
+        self._version = version
+        self._content, self._encoded, self._decoded = state
+        self._origin = None
+        self._touch()
+
+    def _copy(self):
+        fileobj = FakeIOFile(self._filepath, self._mode, None, self._encoding)
+        fileobj._set_state(*self._state())
+        return fileobj
 
-    def _close(self, open_file):
-        if self._open_file == open_file:
-            self._open_file = None
-            return
-        raise ProgrammingException('File is not opened but closed.')
+    def _close(self, open_file, content=None):
+        # Writers pass what they wrote. It replaces the content under the lock
+        # that frees the writer, so that no writer opened in between can see
+        # the old content.
+        with self._lock:
+            if self._writer is not open_file:
+                for i, reader in enumerate(self._readers):
+                    if reader is open_file:
+                        del self._readers[i]
+                        self._touch()
+                        return
+                raise ProgrammingException('File is not opened but closed.')
+            self._writer = None
+            if content is None:
+                self._touch()
+                return
+            self._mtime = time.time()
+            self._apply_state(next(_VERSIONS), (content, None, None))
+        if self._owner is not None:
+            self._owner._file_changed(self)
+
+    def _touch(self):
+        usage = _sizeof(self._content)
+        if self._encoded is not None and self._encoded is not self._content:
+            usage += _sizeof(self._encoded)
+        if self._decoded is not None and self._decoded is not self._content:
+            usage += _sizeof(self._decoded)
+        delta = usage - self._memory
+        self._memory = usage
+        if self._owner is not None:
+            self._owner._touch_file(self, delta)
+
+    def _spill(self, store):
+        # The caller holds the lock of this file.
+        if self._origin is not None:
+            # Unchanged since it was loaded, so it can simply be loaded again.
+            self._content = self._origin
+        else:
+            self._content = _SpilledContent(store, self._resolve_content())
+        self._encoded = None
+        self._decoded = None
+        freed = self._memory
+        self._memory = 0
+        return freed
+
+    def _compress(self, compression):
+        # The caller holds the lock of this file. Returns the memory freed.
+        if self._origin is not None:
+            self._content = self._origin
+        elif (self._content is None or
+              _sizeof(self._content) < _COMPRESS_MIN_SIZE):
+            return 0
+        else:
+            self._content = _CompressedContent(self._resolve_content(),
+                                               compression)
+        self._encoded = None
+        self._decoded = None
+        freed = self._memory - _sizeof(self._content)
+        self._memory -= freed
+        return freed
+
+    def _export_content(self):
+        content = self._encoded_content()
+        if self._encoding is None and isinstance(self._content, unicode):
+            return content, 'utf8'
+        return content, self._encoding
+
+    def _export_shared(self):
+        # The content as bytes, and the encoding that decodes them back to
+        # the text they were, if they were.
+        content, encoding = self._export_content()
+        if isinstance(self._resolve_content(), unicode):
+            return content, encoding
+        return content, None
+
+    def _move_to(self, share):
+        # Replaces the content by a segment of the share, so that it is
+        # neither kept in memory nor copied for other processes.
+        with self._lock:
+            content, decode = self._export_shared()
+            self._content = share._put(content, decode)
+            self._encoded = None
+            self._decoded = None
+            self._origin = None
+            self._touch()
+
+    def memory_usage(self):
+        return self._memory
+
+    def collect_stats(self):
+        if self._stats is None:
+            self._stats = _FileStats()
+
+    def stats(self):
+        if self._stats is None:
+            return None
+        return self._stats.as_dict()
+
+    def _monitors(self):
+        return tuple(monitor for monitor in (self._stats, self._profile)
+                     if monitor is not None)
+
+    def size(self):
+        with self._lock:
+            if isinstance(self._content, _DeferredContent):
+                return self._content.length
+            if isinstance(self._content, unicode):
+                return len(self._encoded_content())
+            if self._content is None:
+                return 0
+            return len(self._content)
 
     def getvalue(self):
-        if self._open_file != None:
-            raise IOError("File is still opened")
-        return self._content
+        self._reap()
+        with self._lock:
+            if self._writer != None or self._readers:
+                raise IOError("File is still opened")
+            content = self._resolve_content()
+            self._touch()
+            return content
+
+class _Future(object):
+    # Minimal stand-in for concurrent.futures.Future, which Python 2 does not
+    # ship. Results of in-memory files are set before it is returned.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    @classmethod
+    def call(cls, func, *args):
+        future = cls()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def cancel(self):
+        return False
+
+    def cancelled(self):
+        return False
+
+    def running(self):
+        return not self._event.is_set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError("Future is not done in %s seconds" % timeout)
+        return self._exception
+
+    def result(self, timeout=None):
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+def _submit(executor, func, *args):
+    if executor is not None:
+        return executor.submit(func, *args)
+    future = _Future()
+    def run():
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return future
+
+class AsyncOpenedFile(object):
+    # Every method returns a future. Calls on in-memory files are done by the
+    # time they return; calls on real files run in the executor, or in a new
+    # thread if there is none.
+
+    def __init__(self, file, in_memory, executor=None):
+        self._file = file
+        self._in_memory = in_memory
+        self._executor = executor
+
+    @property
+    def name(self):
+        return self._file.name
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def read(self, n=-1):
+        return self._call(self._file.read, n)
+
+    def readline(self, limit=-1):
+        return self._call(self._file.readline, limit)
+
+    def readlines(self, hint=-1):
+        return self._call(self._file.readlines, hint)
+
+    def __iter__(self):
+        return self.iterlines()
+
+    def iterlines(self, hint=65536):
+        # Futures of successive batches of lines, each read like
+        # readlines(hint). The batch after the last line is empty, and the
+        # iteration stops once it is done.
+        while True:
+            future = self.readlines(hint)
+            yield future
+            if not future.result():
+                return
+
+    def write(self, s):
+        return self._call(self._file.write, s)
+
+    def writelines(self, lines):
+        return self._call(self._file.writelines, lines)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._call(self._file.seek, offset, whence)
+
+    def tell(self):
+        return self._call(self._file.tell)
+
+    def flush(self):
+        return self._call(self._file.flush)
+
+    def close(self):
+        return self._call(self._file.close)
+
+    def _call(self, func, *args):
+        if self._in_memory:
+            return _Future.call(func, *args)
+        return _submit(self._executor, func, *args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close().result()
+
+class _RegexMatcher(object):
+    # Answers "does any registered regex match this path" without calling
+    # match on every registered regex. Regexes are bucketed by the literal
+    # prefix they start with, so a path only reaches the regexes whose prefix
+    # it shares, and each bucket is matched with a few combined patterns.
 
-class FakeIOSession(object):
     def __init__(self):
-        self._saved_open = None
-        self._mappings = dict()
         self._regexes = []
+        self._buckets = dict()
+        self._lengths = []
 
-    def intercept_regex(self, regex):
+    def __len__(self):
+        return len(self._regexes)
+
+    def __iter__(self):
+        return iter(self._regexes)
+
+    def add(self, regex):
         self._regexes.append(regex)
+        prefix = _literal_prefix(regex)
+        bucket = self._buckets.get(prefix)
+        if bucket is None:
+            bucket = self._buckets[prefix] = _RegexBucket()
+            if len(prefix) not in self._lengths:
+                bisect.insort(self._lengths, len(prefix))
+        bucket.add(regex)
+
+    def match(self, path):
+        buckets = self._buckets
+        for length in self._lengths:
+            bucket = buckets.get(path[:length])
+            if bucket is not None and bucket.match(path):
+                return True
+        return False
+
+class _RegexBucket(object):
+    # Newly added regexes are compiled into an extra chunk on the next match,
+    # and the chunks are merged again once there are too many of them.
+
+    _MAX_CHUNKS = 8
 
-    def create_file(self, filepath, mode='r', content=None):
+    def __init__(self):
+        self._regexes = []
+        self._pending = []
+        self._chunks = []
+        self._lock = threading.Lock()
+
+    def add(self, regex):
+        with self._lock:
+            self._regexes.append(regex)
+            self._pending.append(regex)
+
+    def match(self, path):
+        if self._pending:
+            self._compile_pending()
+        for chunk in self._chunks:
+            if chunk.match(path):
+                return True
+        return False
+
+    def _compile_pending(self):
+        # Matching threads keep using the old list of chunks until the new
+        # one is assigned.
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, []
+            chunks = self._chunks + _combine_regexes(pending)
+            if len(chunks) > self._MAX_CHUNKS:
+                chunks = _combine_regexes(self._regexes)
+            self._chunks = chunks
+
+def _literal_prefix(regex):
+    pattern = getattr(regex, 'pattern', None)
+    flags = getattr(regex, 'flags', None)
+    if not isinstance(pattern, basestring) or flags is None:
+        return ''
+    if flags & re.IGNORECASE:
+        return ''
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except Exception:
+        return ''
+    chars = []
+    for op, av in parsed:
+        if op == sre_constants.AT and av in (sre_constants.AT_BEGINNING,
+                                             sre_constants.AT_BEGINNING_STRING):
+            if chars:
+                break
+        elif op == sre_constants.LITERAL:
+            chars.append(unichr(av))
+        else:
+            break
+    return ''.join(chars)
+
+_GROUP_REFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+def _combine_regexes(regexes):
+    groups = dict()
+    combined = []
+    for regex in regexes:
+        pattern = getattr(regex, 'pattern', None)
+        flags = getattr(regex, 'flags', None)
+        if (not isinstance(pattern, basestring) or flags is None or
+                (regex.groups and _GROUP_REFERENCE.search(pattern))):
+            # Not a compiled re pattern, or one that refers to its groups by
+            # number, which would break once it is part of an alternation.
+            combined.append(regex)
+            continue
+        groups.setdefault((flags, type(pattern)), []).append(regex)
+    for (flags, _), group in groups.items():
+        combined.extend(_combine_regex_group(group, flags))
+    return combined
+
+def _combine_regex_group(regexes, flags):
+    if len(regexes) == 1:
+        return regexes
+    if flags & re.VERBOSE:
+        template = '(?:%s\n)'
+    else:
+        template = '(?:%s)'
+    try:
+        return [re.compile('|'.join(template % regex.pattern
+                                    for regex in regexes), flags)]
+    except (re.error, AssertionError, OverflowError, RuntimeError):
+        # Too many groups or conflicting group names. Split until each part
+        # compiles on its own.
+        half = len(regexes) // 2
+        return (_combine_regex_group(regexes[:half], flags) +
+                _combine_regex_group(regexes[half:], flags))
+
+class _Directory(object):
+    def __init__(self):
+        self.dirs = dict()
+        self.files = set()
+
+class _DirectoryIndex(object):
+    # Tree of the directories that contain faked files, kept next to the
+    # flat mappings so that a directory lookup costs the depth of the path.
+    # Directories exist as long as some file is under them.
+
+    def __init__(self):
+        self._root = _Directory()
+
+    def add(self, filepath):
+        parts = _split_path(filepath)
+        directory = self._root
+        for part in parts[:-1]:
+            child = directory.dirs.get(part)
+            if child is None:
+                child = directory.dirs[part] = _Directory()
+            directory = child
+        directory.files.add(parts[-1])
+
+    def remove(self, filepath):
+        parts = _split_path(filepath)
+        directories = [self._root]
+        for part in parts[:-1]:
+            directory = directories[-1].dirs.get(part)
+            if directory is None:
+                return
+            directories.append(directory)
+        directories[-1].files.discard(parts[-1])
+        for i in range(len(directories) - 1, 0, -1):
+            if directories[i].dirs or directories[i].files:
+                break
+            del directories[i - 1].dirs[parts[i - 1]]
+
+    def directory(self, path):
+        directory = self._root
+        for part in _split_path(path):
+            directory = directory.dirs.get(part)
+            if directory is None:
+                return None
+        return directory
+
+class _PathIndex(object):
+    # Sorted list of the mapped paths, so that the paths under a prefix are a
+    # slice of it, and the paths in the order of the version at which they
+    # were last added or changed, so that the paths changed since a version
+    # are the tail of it. Versions must be given in increasing order.
+
+    def __init__(self):
+        self._paths = []
+        self._versions = collections.OrderedDict()
+
+    def add(self, filepath, version):
+        if self._versions.pop(filepath, None) is None:
+            bisect.insort(self._paths, filepath)
+        self._versions[filepath] = version
+
+    def update(self, filepaths, version):
+        # Sorting once beats inserting one by one when many files are added.
+        new = set(filepath for filepath in filepaths
+                  if filepath not in self._versions)
+        self._paths.extend(new)
+        self._paths.sort()
+        for filepath in filepaths:
+            self._versions.pop(filepath, None)
+            self._versions[filepath] = version
+
+    def changed(self, filepath, version):
+        if self._versions.pop(filepath, None) is not None:
+            self._versions[filepath] = version
+
+    def remove(self, filepath):
+        if self._versions.pop(filepath, None) is not None:
+            del self._paths[bisect.bisect_left(self._paths, filepath)]
+
+    def changed_since(self, version):
+        changed = []
+        for filepath in reversed(self._versions):
+            if self._versions[filepath] <= version:
+                break
+            changed.append(filepath)
+        changed.sort()
+        return changed
+
+    def paths(self):
+        return list(self._paths)
+
+    def prefixed(self, prefix):
+        start = end = bisect.bisect_left(self._paths, prefix)
+        while end < len(self._paths) and self._paths[end].startswith(prefix):
+            end += 1
+        return self._paths[start:end]
+
+    def glob(self, pattern):
+        # Wildcards do not match across directories, as in glob.
+        literal = re.match(r'[^*?[]*', pattern).group()
+        regex = re.compile(fnmatch.translate(pattern))
+        depth = pattern.count('/')
+        return [filepath for filepath in self.prefixed(literal)
+                if filepath.count('/') == depth and regex.match(filepath)]
+
+class _MappingsView(collections.Mapping):
+    # Read only view of the files of a session, iterated in path order.
+
+    def __init__(self, session):
+        self._session = session
+
+    def __getitem__(self, filepath):
+        return self._session._mappings[filepath]
+
+    def __contains__(self, filepath):
+        return filepath in self._session._mappings
+
+    def __len__(self):
+        return len(self._session._mappings)
+
+    def __iter__(self):
+        with self._session._lock:
+            return iter(self._session._paths.paths())
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, dict(self))
+
+class _PrefixFilter(object):
+    # Rejects paths that cannot be faked before they are normalized. Every
+    # mapped path and regex literal prefix is kept cut down to the length of
+    # the shortest one, so a path only has to normalize that many characters.
+
+    def __init__(self):
+        self._state = (None, set())
+
+    def add(self, prefix):
+        # The length and the heads are replaced together so that a
+        # concurrent may_match never sees one without the other.
+        length, heads = self._state
+        if length is None or len(prefix) < length:
+            length = len(prefix)
+            heads = set(head[:length] for head in heads)
+            heads.add(prefix)
+            self._state = (length, heads)
+        else:
+            heads.add(prefix[:length])
+
+    def may_match(self, path):
+        length, heads = self._state
+        if length is None or not isinstance(path, basestring):
+            return False
+        return _normalize_path(path[:length]) in heads
+
+# The functions a session replaces, with the session methods replacing them.
+_HOOKS = [
+    (__builtin__, 'open', '_fake_open'),
+    (io, 'open', '_fake_io_open'),
+    (os.path, 'exists', '_fake_exists'),
+    (os.path, 'isfile', '_fake_isfile'),
+    (os.path, 'isdir', '_fake_isdir'),
+    (os, 'listdir', '_fake_listdir'),
+    (os, 'stat', '_fake_stat'),
+    (os, 'open', '_fake_os_open'),
+    (os, 'close', '_fake_os_close'),
+    (os, 'fstat', '_fake_fstat'),
+    ]
+
+class _ThreadDispatcher(object):
+    # Replaces the hooked functions while any thread scoped session is
+    # entered, and hands every call to the innermost session entered by the
+    # calling thread. Threads without such a session get the real functions.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._entered = 0
+        self.saved = None
+
+    def push(self, session):
+        with self._lock:
+            if not self._entered:
+                self.saved = dict((method, getattr(module, name))
+                                  for module, name, method in _HOOKS)
+                for module, name, method in _HOOKS:
+                    setattr(module, name, self._dispatcher(method))
+            self._entered += 1
+        self._sessions().append(session)
+
+    def pop(self, session):
+        sessions = self._sessions()
+        if not sessions or sessions[-1] is not session:
+            raise ProgrammingException('Session is not entered but exited.')
+        sessions.pop()
+        with self._lock:
+            self._entered -= 1
+            if not self._entered:
+                for module, name, method in _HOOKS:
+                    setattr(module, name, self.saved[method])
+                self.saved = None
+
+    def _sessions(self):
+        try:
+            return self._local.sessions
+        except AttributeError:
+            self._local.sessions = []
+            return self._local.sessions
+
+    def _dispatcher(self, method):
+        saved = self.saved[method]
+        local = self._local
+        def dispatch(*args, **kwargs):
+            sessions = getattr(local, 'sessions', None)
+            if sessions:
+                return getattr(sessions[-1], method)(*args, **kwargs)
+            return saved(*args, **kwargs)
+        return dispatch
+
+_THREAD_DISPATCHER = _ThreadDispatcher()
+
+class _SessionSnapshot(object):
+    # The files of a session at some point, and where the session journal
+    # was at that point. Restoring only visits the paths journaled since.
+
+    def __init__(self, session, index, files):
+        self.session = session
+        self.index = index
+        self.files = files
+
+_SEGMENTS = itertools.count(1)
+
+class FakeIOShare(object):
+    # The files of a session in segment files of a directory that other
+    # processes can read, preferably on tmpfs. It pickles to the directory and
+    # an index of the segments, so it can be handed to multiprocessing
+    # workers. Each process writes changed files to new segments and appends
+    # them to a journal, which sync() applies to the session of the process.
+    # Every write publishes the whole file, so appends cost the size of it.
+    #
+    # A process removes the segments it wrote once it wrote the file again
+    # and every other process that syncs has synced past that, as found in
+    # their synced-<pid> files. Processes with snapshots stop reporting, as
+    # the snapshots may hold older segments. Segments of the index and those
+    # written again by another process stay until the share is closed.
+
+    def __init__(self, dirpath, index, regexes):
+        self._dirpath = dirpath
+        self._index = index
+        self._regexes = regexes
+        self._session = None
+        self._offset = 0
+        self._reported = False
+        self._published = dict()
+        self._superseded = []
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return (self._dirpath, self._index, self._regexes)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    @property
+    def dirpath(self):
+        return self._dirpath
+
+    def session(self, **kwargs):
+        session = FakeIOSession(**kwargs)
+        for regex in self._regexes:
+            session.intercept_regex(regex)
+        session._add_files([
+            FakeIOFile(filepath, mode,
+                       self._content(segment, length, decode), encoding)
+            for filepath, (mode, encoding, decode, segment, length)
+            in self._index.iteritems()])
+        self._attach(session)
+        self.sync()
+        return session
+
+    def install(self, **kwargs):
+        # Meant as initializer of multiprocessing pools; the session stays
+        # entered for the rest of the process.
+        session = self.session(**kwargs)
+        session.__enter__()
+        return session
+
+    def sync(self):
+        session = self._session
+        with self._lock:
+            if not self._reported:
+                # Before reading, so that no segment read is removed.
+                self._report()
+            try:
+                with _real_open(self._journal_path(), 'rb') as fileobj:
+                    fileobj.seek(self._offset)
+                    data = fileobj.read()
+            except IOError:
+                return 0
+            # A record may be half written by another process.
+            end = data.rfind(b'\n') + 1
+            self._offset += end
+        pid = os.getpid()
+        updates = dict()
+        for line in data[:end].splitlines():
+            record = json.loads(line)
+            if record[0] != pid:
+                updates[record[1]] = record[2:]
+        for filepath, (mode, encoding, decode, segment, length) in \
+                updates.iteritems():
+            content = self._content(segment, length, decode)
+            fileobj = session._mappings.get(filepath)
+            if fileobj is None:
+                session._add_file(
+                    filepath, FakeIOFile(filepath, mode, content, encoding))
+            else:
+                fileobj._mtime = time.time()
+                fileobj._set_state(next(_VERSIONS), (content, None, None))
+                session._file_changed(fileobj, publish=False)
+        if not session._snapshots:
+            with self._lock:
+                self._report()
+        return len(updates)
+
+    def close(self):
+        # Loads the shared contents back into the session before removing the
+        # segments. Shares unpickled in other processes must not be used after.
+        session = self._session
+        if session is not None:
+            session._share = None
+            with session._lock:
+                fileobjs = session._mappings.values()
+            for fileobj in fileobjs:
+                with fileobj._lock:
+                    if isinstance(fileobj._content, _SharedContent):
+                        fileobj._resolve_content()
+                        fileobj._origin = None
+                        fileobj._touch()
+            self._session = None
+        shutil.rmtree(self._dirpath, ignore_errors=True)
+
+    def _attach(self, session):
+        # A forked process starts over with the share of its parent.
+        self._session = session
+        self._offset = 0
+        self._reported = False
+        self._published = dict()
+        self._superseded = []
+        session._share = self
+
+    def _content(self, segment, length, decode=None):
+        return _SharedContent(os.path.join(self._dirpath, segment), length,
+                              decode)
+
+    def _journal_path(self):
+        return os.path.join(self._dirpath, 'journal')
+
+    def _put(self, content, decode=None):
+        segment = '%d-%d' % (os.getpid(), next(_SEGMENTS))
+        with _real_open(os.path.join(self._dirpath, segment), 'wb') as fileobj:
+            fileobj.write(content)
+        return _SharedContent(os.path.join(self._dirpath, segment),
+                              len(content), decode)
+
+    def _publish(self, fileobj):
+        with fileobj._lock:
+            content, decode = fileobj._export_shared()
+            encoding = fileobj._encoding
+        shared = self._put(content, decode)
+        segment = os.path.basename(shared._path)
+        record = json.dumps([os.getpid(), fileobj._filepath, fileobj._mode,
+                             encoding, decode, segment, shared.length])
+        # Appends of a single write do not interleave between processes.
+        fd = _real_os_open(self._journal_path(),
+                           os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, record.encode('utf8') + b'\n')
+            end = os.lseek(fd, 0, os.SEEK_CUR)
+        finally:
+            _real_os_close(fd)
+        with self._lock:
+            previous = self._published.get(fileobj._filepath)
+            self._published[fileobj._filepath] = segment
+            if previous is not None:
+                self._superseded.append((end, previous))
+            self._collect()
+
+    def _report(self):
+        # The caller holds the lock of the share.
+        path = os.path.join(self._dirpath, 'synced-%d' % os.getpid())
+        with _real_open(path + '.tmp', 'wb') as fileobj:
+            fileobj.write(str(self._offset))
+        os.rename(path + '.tmp', path)
+        self._reported = True
+
+    def _collect(self):
+        # The caller holds the lock of the share. Removes the segments
+        # written again before every other process synced to.
+        if not self._superseded:
+            return
+        pid = os.getpid()
+        synced = None
+        for name in _real_listdir(self._dirpath):
+            if not name.startswith('synced-') or name.endswith('.tmp'):
+                continue
+            other = int(name[len('synced-'):])
+            if other == pid:
+                continue
+            path = os.path.join(self._dirpath, name)
+            try:
+                os.kill(other, 0)
+            except OSError as e:
+                if e.errno == errno.ESRCH:
+                    # Exited without closing, as pool workers do.
+                    os.unlink(path)
+                    continue
+            try:
+                with _real_open(path, 'rb') as fileobj:
+                    offset = int(fileobj.read())
+            except IOError:
+                continue
+            synced = offset if synced is None else min(synced, offset)
+        kept = []
+        for end, segment in self._superseded:
+            if synced is None or end <= synced:
+                os.unlink(os.path.join(self._dirpath, segment))
+            else:
+                kept.append((end, segment))
+        self._superseded = kept
+
+class FakeIOSession(object):
+    def __init__(self, memory_budget=None, spill_policy='lru',
+                 scope='global', collect_stats=False, clock=None,
+                 overlay_budget=None, compression=None, compress_after=1.0):
+        if spill_policy not in ('lru', 'largest'):
+            raise ValueError("Unknown spill policy %r" % spill_policy)
+        if compression is not None and compression not in _COMPRESSORS:
+            raise ValueError("Unknown compression %r" % compression)
+        if scope not in ('global', 'thread'):
+            raise ValueError("Unknown scope %r" % scope)
+        self._scope = scope
+        self._collect_stats = collect_stats
+        self._lock = threading.RLock()
+        self._saved = dict()
+        self._saved_open = None
+        self._saved_io_open = None
+        self._mappings = dict()
+        self._paths = _PathIndex()
+        self._view = _MappingsView(self)
+        self._regexes = _RegexMatcher()
+        self._filter = _PrefixFilter()
+        self._directories = _DirectoryIndex()
+        self._log_opens = False
+        self._memory_budget = memory_budget
+        self._spill_policy = spill_policy
+        self._memory_usage = 0
+        self._recent = collections.OrderedDict()
+        self._spill_store = _SpillStore()
+        self._compression = compression
+        self._compress_after = compress_after
+        self._idle = collections.OrderedDict()
+        self._journal = None
+        self._snapshots = weakref.WeakSet()
+        self._share = None
+        self._clock = clock if clock is not None else VirtualClock()
+        self._profile = None
+        self._profiles = []
+        self._overlays = []
+        self._overlay_budget = overlay_budget
+        self._overlay_bytes = 0
+        self._overlay_cache = collections.OrderedDict()
+        self._descriptors = dict()
+        self._miss_handler = None
+        self._unrecorded_handler = None
+        self._recording = None
+        self._recorded = None
+        self._misses = set()
+        self._strict = False
+
+    def intercept_regex(self, regex):
+        with self._lock:
+            self._regexes.add(regex)
+            self._filter.add(_literal_prefix(regex))
+
+    def create_file(self, filepath, mode='r', content=None, cache=False,
+                    length=None):
+        # Content may also be a callable or an iterable producing chunks,
+        # which readers pull while they read. Callables are called again for
+        # every reader; other iterables are only read once unless cached.
+        # Without the length in bytes, stat pulls the chunks to count them.
         filepath = _normalize_path(filepath)
+        if callable(content) or hasattr(content, '__iter__'):
+            content = _StreamContent(content, cache, length)
         fileobj = FakeIOFile(filepath, mode, content)
-        self._mappings[filepath] = fileobj
+        self._add_file(filepath, fileobj)
         return fileobj
 
+    def overlay_directory(self, dirpath):
+        # Real files under dirpath are read through into the session when
+        # they are opened, and cached there until they change on the disk or
+        # fall out of the overlay budget. Writes, also of new files, stay in
+        # the session like writes to any other fake.
+        root = _normalize_path(dirpath).rstrip('/')
+        with self._lock:
+            self._overlays.append(root)
+            self._filter.add(root + '/')
+
+    def start_recording(self, regex=None):
+        # Opens that are not faked still go to the disk, but the files they
+        # open are recorded: with their content as it was before the first
+        # open, and writable if any open wrote them.
+        if isinstance(regex, basestring):
+            regex = re.compile(regex)
+        with self._lock:
+            if self._recorded is None:
+                self._unrecorded_handler = self._miss_handler
+            self._recording = regex
+            self._recorded = dict()
+            self._miss_handler = self._record_miss
+
+    def stop_recording(self):
+        # Returns a session replaying the recorded files, which reports the
+        # opens it cannot fake.
+        with self._lock:
+            recorded = self._recorded
+            if recorded is None:
+                raise ProgrammingException(
+                    'Recording is not started but stopped.')
+            self._recorded = None
+            self._recording = None
+            self._miss_handler = self._unrecorded_handler
+            self._unrecorded_handler = None
+        session = FakeIOSession()
+        session._add_files([
+            FakeIOFile(filepath, mode, content)
+            for filepath, (mode, content) in sorted(recorded.iteritems())])
+        session.track_misses()
+        return session
+
+    def track_misses(self, strict=False):
+        # Strict sessions refuse to open files they do not fake.
+        with self._lock:
+            self._strict = strict
+            self._miss_handler = self._track_miss
+
+    def misses(self):
+        with self._lock:
+            return sorted(self._misses)
+
+    def _record_miss(self, filepath, mode):
+        normalized_path = _normalize_path(filepath)
+        regex = self._recording
+        if regex is not None and not regex.match(normalized_path):
+            return
+        writing = mode.startswith(('w', 'a')) or '+' in mode
+        content = None
+        if normalized_path not in self._recorded:
+            # Read before the open itself may truncate the file.
+            try:
+                if stat.S_ISREG(_real_stat(filepath).st_mode):
+                    with _real_open(filepath, 'rb') as fileobj:
+                        content = fileobj.read()
+            except (IOError, OSError):
+                pass
+            if content is None and not writing:
+                return
+        with self._lock:
+            if self._recorded is None:
+                return
+            entry = self._recorded.setdefault(normalized_path,
+                                              ['r', content])
+            if writing:
+                entry[0] = 'rw'
+
+    def _track_miss(self, filepath, mode):
+        normalized_path = _normalize_path(filepath)
+        with self._lock:
+            missed = normalized_path not in self._misses
+            self._misses.add(normalized_path)
+        if missed:
+            LOGGER.warning("Open file %s is not faked", filepath)
+        if self._strict:
+            raise IOError(errno.ENOENT, os.strerror(errno.ENOENT), filepath)
+
+    def mount_directory(self, dirpath, prefix, mode='r'):
+        # Registers every file under dirpath below prefix. Contents are read
+        # from the disk when a file is opened for the first time.
+        members = []
+        for root, _, filenames in os.walk(dirpath):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                members.append((os.path.relpath(path, dirpath),
+                                _DiskContent(path)))
+        return self._mount(prefix, mode, members)
+
+    def mount_tar(self, archivepath, prefix, mode='r'):
+        archive = _TarArchive(archivepath)
+        return self._mount(prefix, mode, [
+            (name, _ArchiveContent(archive, member, length))
+            for name, member, length in archive.members()])
+
+    def mount_zip(self, archivepath, prefix, mode='r'):
+        archive = _ZipArchive(archivepath)
+        return self._mount(prefix, mode, [
+            (name, _ArchiveContent(archive, member, length))
+            for name, member, length in archive.members()])
+
+    def save_image(self, imagepath):
+        with self._lock:
+            mappings = self._mappings.copy()
+        entries = []
+        for filepath in sorted(mappings):
+            fileobj = mappings[filepath]
+            with fileobj._lock:
+                content, decode = fileobj._export_shared()
+            entries.append((filepath, fileobj._mode, fileobj._encoding,
+                            decode, content))
+        _write_image(imagepath, entries)
+        return len(entries)
+
+    def load_image(self, imagepath):
+        # The image is mapped into memory and contents are copied out of it
+        # when a file is opened for the first time.
+        image = _Image(imagepath)
+        # None of the objects created here is garbage, yet creating them
+        # would run full collections over all of them again and again.
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            fileobjs = [
+                FakeIOFile(filepath, mode,
+                           _ArchiveContent(image, member, length, decode),
+                           encoding)
+                for filepath, (mode, encoding, decode), member, length
+                in image.members()]
+            self._add_files(fileobjs)
+        finally:
+            if enabled:
+                gc.enable()
+        return len(fileobjs)
+
+    def _mount(self, prefix, mode, members):
+        prefix = _normalize_path(prefix).rstrip('/')
+        fileobjs = []
+        for name, content in members:
+            filepath = '%s/%s' % (prefix, _normalize_path(name).lstrip('/'))
+            fileobjs.append(FakeIOFile(filepath, mode, content))
+        self._add_files(fileobjs)
+        return len(fileobjs)
+
+    def memory_usage(self):
+        return self._memory_usage
+
+    def memory_stats(self):
+        compressed = [fileobj._content
+                      for fileobj in self._mappings.values()
+                      if isinstance(fileobj._content, _CompressedContent)]
+        return {
+            'memory_budget': self._memory_budget,
+            'memory_usage': self._memory_usage,
+            'spilled_bytes': self._spill_store.nbytes,
+            'spilled_files': sum(
+                1 for fileobj in self._mappings.itervalues()
+                if isinstance(fileobj._content, _SpilledContent)),
+            'compressed_files': len(compressed),
+            'compressed_bytes': sum(content.nbytes for content in compressed),
+            'uncompressed_bytes': sum(
+                content.length for content in compressed),
+            }
+
+    def snapshot(self):
+        with self._lock:
+            if self._journal is None:
+                self._journal = []
+            index = len(self._journal)
+            mappings = self._mappings.copy()
+        files = dict((filepath, (fileobj,) + fileobj._state())
+                     for filepath, fileobj in mappings.iteritems())
+        snapshot = _SessionSnapshot(self, index, files)
+        with self._lock:
+            self._snapshots.add(snapshot)
+        return snapshot
+
+    def restore(self, snapshot):
+        # Restoring journals the paths it changes as well, so that restoring
+        # any other snapshot afterwards still visits every changed path.
+        if snapshot.session is not self:
+            raise ValueError("Snapshot is taken from another session")
+        with self._lock:
+            filepaths = set(self._journal[snapshot.index:])
+        for filepath in filepaths:
+            entry = snapshot.files.get(filepath)
+            if entry is None:
+                self._remove_file(filepath)
+                continue
+            fileobj, version, state = entry
+            if self._mappings.get(filepath) is not fileobj:
+                self._add_file(filepath, fileobj)
+            if fileobj._version != version:
+                if isinstance(state[0], _DeferredContent):
+                    state[0].retain()
+                fileobj._set_state(version, state)
+                self._file_changed(fileobj)
+        self._compact_journal(snapshot)
+
+    def _compact_journal(self, snapshot):
+        # Every snapshot must find the paths that differ from it after its
+        # index. Those of snapshots taken after the restored one are among
+        # the paths journaled since it, so they are moved to its index, and
+        # each path is only kept once.
+        with self._lock:
+            index = snapshot.index
+            tail = collections.OrderedDict.fromkeys(self._journal[index:])
+            del self._journal[index:]
+            others = [other for other in self._snapshots
+                      if other is not snapshot]
+            if others:
+                self._journal.extend(tail)
+            for other in others:
+                other.index = min(other.index, index)
+
+    def clone(self):
+        with self._lock:
+            session = FakeIOSession(self._memory_budget, self._spill_policy,
+                                    self._scope, self._collect_stats,
+                                    self._clock, self._overlay_budget,
+                                    self._compression, self._compress_after)
+            for regex in self._regexes:
+                session.intercept_regex(regex)
+            for root in self._overlays:
+                session.overlay_directory(root)
+            session._profile = self._profile
+            session._profiles = list(self._profiles)
+            mappings = self._mappings.copy()
+            # Copies of the disk are read through again by the clone.
+            for filepath in self._overlay_cache:
+                del mappings[filepath]
+        session._spill_store = self._spill_store
+        for filepath, fileobj in mappings.iteritems():
+            session._add_file(filepath, fileobj._copy())
+        return session
+
+    def share(self, dirpath=None):
+        if dirpath is None:
+            dirpath = tempfile.mkdtemp(prefix='fakeio-', dir=_tmpfs_dir())
+        with self._lock:
+            mappings = self._mappings.copy()
+            regexes = list(self._regexes)
+        share = FakeIOShare(dirpath, dict(), regexes)
+        for filepath, fileobj in mappings.iteritems():
+            fileobj._move_to(share)
+            content = fileobj._content
+            share._index[filepath] = (fileobj._mode, fileobj._encoding,
+                                      content.decode,
+                                      os.path.basename(content._path),
+                                      content.length)
+        share._attach(self)
+        return share
+
+    @property
+    def clock(self):
+        return self._clock
+
+    def set_profile(self, profile, regex=None):
+        # Profiles set for a regex take precedence over the profile of the
+        # session, and the last one set over earlier ones. Setting None
+        # removes a profile. Files opened before keep their old profile.
+        if isinstance(regex, basestring):
+            regex = re.compile(regex)
+        with self._lock:
+            if regex is None:
+                self._profile = profile
+            else:
+                self._profiles = [
+                    entry for entry in self._profiles
+                    if entry[0].pattern != regex.pattern]
+                if profile is not None:
+                    self._profiles.insert(0, (regex, profile))
+            for filepath, fileobj in self._mappings.iteritems():
+                fileobj._profile = self._profile_monitor(filepath)
+
+    def _profile_monitor(self, filepath):
+        for regex, profile in self._profiles:
+            if regex.match(filepath):
+                break
+        else:
+            profile = self._profile
+        if profile is None:
+            return None
+        return _ProfileMonitor(profile, self._clock)
+
+    def stats(self):
+        with self._lock:
+            mappings = self._mappings.copy()
+        files = dict()
+        total = dict()
+        for filepath, fileobj in mappings.iteritems():
+            stats = fileobj.stats()
+            if stats is not None:
+                files[filepath] = stats
+                _merge_stats(total, stats)
+        return {'files': files, 'total': total}
+
+    def stats_json(self):
+        return json.dumps(self.stats(), sort_keys=True)
+
+    def _add_file(self, filepath, fileobj):
+        with self._lock:
+            replaced = self._mappings.get(filepath)
+            if replaced is not None:
+                self._forget_file(replaced)
+            self._mappings[filepath] = fileobj
+            self._paths.add(filepath, next(_VERSIONS))
+            self._filter.add(filepath)
+            self._directories.add(filepath)
+            fileobj._owner = self
+            if self._collect_stats:
+                fileobj.collect_stats()
+            fileobj._profile = self._profile_monitor(filepath)
+            self._memory_usage += fileobj.memory_usage()
+            if self._journal is not None:
+                self._journal.append(filepath)
+        # Touching takes the lock of the file, which must never be waited for
+        # while holding the lock of the session.
+        fileobj._touch()
+
+    def _add_files(self, fileobjs):
+        # Same as _add_file for files whose content is not loaded yet, and
+        # which therefore need no touch, under a single lock.
+        with self._lock:
+            self._paths.update([fileobj._filepath for fileobj in fileobjs],
+                               next(_VERSIONS))
+            for fileobj in fileobjs:
+                filepath = fileobj._filepath
+                replaced = self._mappings.get(filepath)
+                if replaced is not None:
+                    self._forget_file(replaced)
+                self._mappings[filepath] = fileobj
+                self._filter.add(filepath)
+                self._directories.add(filepath)
+                fileobj._owner = self
+                if self._collect_stats:
+                    fileobj.collect_stats()
+                fileobj._profile = self._profile_monitor(filepath)
+                if self._journal is not None:
+                    self._journal.append(filepath)
+
+    def _remove_file(self, filepath):
+        with self._lock:
+            fileobj = self._mappings.pop(filepath, None)
+            if fileobj is None:
+                return
+            self._paths.remove(filepath)
+            self._directories.remove(filepath)
+            self._forget_file(fileobj)
+            if self._journal is not None:
+                self._journal.append(filepath)
+
+    def _forget_file(self, fileobj):
+        self._memory_usage -= fileobj.memory_usage()
+        self._recent.pop(fileobj, None)
+        self._idle.pop(fileobj, None)
+        fileobj._owner = None
+
+    def _file_changed(self, fileobj, publish=True):
+        with self._lock:
+            self._paths.changed(fileobj._filepath, next(_VERSIONS))
+            if self._journal is not None:
+                self._journal.append(fileobj._filepath)
+            if fileobj._filepath in self._overlay_cache:
+                # Written, so it is no longer a copy of the disk.
+                self._uncache_overlay(fileobj._filepath)
+            share = self._share
+        if publish and share is not None:
+            share._publish(fileobj)
+
+    def _lookup(self, normalized_path):
+        fileobj = self._mappings.get(normalized_path)
+        if self._overlays and (fileobj is None or
+                               normalized_path in self._overlay_cache):
+            fileobj = self._read_through(normalized_path, fileobj)
+        if fileobj is not None or not self._regexes.match(normalized_path):
+            return fileobj
+        with self._lock:
+            # Another thread may have created it since the first lookup.
+            fileobj = self._mappings.get(normalized_path)
+            if fileobj is not None:
+                return fileobj
+            fileobj = FakeIOFile(normalized_path, 'rw', None)
+            self._add_file(normalized_path, fileobj)
+            return fileobj
+
+    def _in_overlay(self, normalized_path):
+        for root in self._overlays:
+            if normalized_path.startswith(root + '/'):
+                return True
+        return False
+
+    def _read_through(self, normalized_path, fileobj):
+        # Cached copies of the disk are checked against it on every lookup,
+        # which costs a stat instead of reading the file again.
+        if fileobj is None and not self._in_overlay(normalized_path):
+            return None
+        try:
+            stat_result = _real_stat(normalized_path)
+        except OSError:
+            stat_result = None
+        with self._lock:
+            current = self._mappings.get(normalized_path)
+            entry = self._overlay_cache.get(normalized_path)
+            if current is not None and (entry is None or
+                                        entry[0] is not current):
+                return current
+            if stat_result is None or not stat.S_ISREG(stat_result.st_mode):
+                if entry is not None:
+                    self._uncache_overlay(normalized_path)
+                    self._remove_file(normalized_path)
+                return None
+            key = (stat_result.st_mtime, stat_result.st_size)
+            if entry is not None and entry[1] == key:
+                del self._overlay_cache[normalized_path]
+                self._overlay_cache[normalized_path] = entry
+                return current
+            fileobj = FakeIOFile(normalized_path, 'rw',
+                                 _DiskContent(normalized_path))
+            self._add_files([fileobj])
+            if entry is not None:
+                self._uncache_overlay(normalized_path)
+            self._overlay_cache[normalized_path] = (fileobj, key)
+            self._overlay_bytes += stat_result.st_size
+            while self._overlay_budget is not None and \
+                    self._overlay_bytes > self._overlay_budget and \
+                    len(self._overlay_cache) > 1:
+                filepath = next(iter(self._overlay_cache))
+                self._uncache_overlay(filepath)
+                self._remove_file(filepath)
+            return fileobj
+
+    def _uncache_overlay(self, filepath):
+        # The caller holds the lock of the session.
+        _, key = self._overlay_cache.pop(filepath)
+        self._overlay_bytes -= key[1]
+
+    def _create_in_overlay(self, normalized_path, mode):
+        # New files under overlaid directories are created in the session.
+        if not mode.startswith(('w', 'a')) or \
+                not self._in_overlay(normalized_path):
+            return None
+        with self._lock:
+            fileobj = self._mappings.get(normalized_path)
+            if fileobj is None:
+                fileobj = FakeIOFile(normalized_path, 'rw', None)
+                self._add_file(normalized_path, fileobj)
+            return fileobj
+
+    def _touch_file(self, fileobj, delta):
+        with self._lock:
+            self._memory_usage += delta
+            if self._compression is not None:
+                self._idle.pop(fileobj, None)
+                self._idle[fileobj] = time.time()
+                self._compress_files(fileobj)
+            if self._memory_budget is None:
+                return
+            self._recent.pop(fileobj, None)
+            self._recent[fileobj] = None
+            if self._memory_usage > self._memory_budget:
+                self._spill_files(fileobj)
+
+    def compress_idle(self):
+        # Files are otherwise only compressed when another file is touched.
+        if self._compression is not None:
+            with self._lock:
+                self._compress_files(None)
+
+    def _compress_files(self, touched):
+        # Compresses the files closed longer than compress_after ago, oldest
+        # first. As in _spill_files, busy files are skipped; open files are
+        # tracked again when they are closed.
+        deadline = time.time() - self._compress_after
+        done = []
+        for fileobj, touched_at in self._idle.iteritems():
+            if touched_at > deadline:
+                break
+            if fileobj is touched or not fileobj._lock.acquire(False):
+                continue
+            try:
+                if (fileobj._writer is None and not fileobj._readers and
+                        not isinstance(fileobj._content, _DeferredContent)):
+                    self._memory_usage -= fileobj._compress(self._compression)
+                done.append(fileobj)
+            finally:
+                fileobj._lock.release()
+        for fileobj in done:
+            del self._idle[fileobj]
+
+    def _spill_files(self, touched):
+        # Files with open handles cannot be spilled since the handles keep
+        # their content alive anyway. Files locked by another thread are
+        # skipped rather than waited for, as that thread may be waiting for
+        # the lock of the session.
+        candidates = list(self._recent)
+        if self._spill_policy == 'largest':
+            candidates.sort(key=lambda fileobj: fileobj.memory_usage(),
+                            reverse=True)
+        for fileobj in candidates:
+            if self._memory_usage <= self._memory_budget:
+                break
+            if fileobj is touched or not fileobj._lock.acquire(False):
+                continue
+            try:
+                # Deferred contents, streams included, take no memory yet.
+                if (fileobj._writer is not None or fileobj._readers or
+                        fileobj._content is None or
+                        isinstance(fileobj._content, _DeferredContent)):
+                    continue
+                self._memory_usage -= fileobj._spill(self._spill_store)
+                del self._recent[fileobj]
+            finally:
+                fileobj._lock.release()
+
     @property
     def mappings(self):
-        return self._mappings.copy()
+        return self._view
+
+    def paths_with_prefix(self, prefix):
+        with self._lock:
+            return self._paths.prefixed(_normalize_path(prefix))
+
+    def glob(self, pattern):
+        with self._lock:
+            return self._paths.glob(_normalize_path(pattern))
+
+    def marker(self):
+        # Files added or written after a marker is taken are changed since it.
+        return next(_VERSIONS)
+
+    def changed_since(self, marker):
+        with self._lock:
+            return self._paths.changed_since(marker)
+
+    def async_open(self, filepath, mode='r', buffering=-1, encoding=None,
+                   errors=None, newline=None, closefd=True, executor=None):
+        # Opens like io.open and returns a future of an AsyncOpenedFile. Only
+        # files that are not faked are opened through the executor.
+        saved_io_open = self._saved_io_open or io.open
+        fileobj = None
+        if self._filter.may_match(filepath):
+            fileobj = self._lookup(_normalize_path(filepath))
+        if fileobj is not None:
+            return _Future.call(
+                lambda: AsyncOpenedFile(
+                    fileobj.io_open(mode, encoding, errors, newline), True))
+        return _submit(executor, lambda: AsyncOpenedFile(
+            saved_io_open(filepath, mode, buffering, encoding, errors,
+                          newline, closefd), False, executor))
 
     def _fake_open(self, filepath, mode='r', buffering=-1):
-        LOGGER.info("Open file %s in mode %s with buffering %d" %
-                    (filepath, mode, buffering))
+        if self._log_opens:
+            LOGGER.info("Open file %s in mode %s with buffering %d",
+                        filepath, mode, buffering)
+        if not self._filter.may_match(filepath):
+            if self._miss_handler is not None:
+                self._miss_handler(filepath, mode)
+            return self._saved_open(filepath, mode, buffering)
         normalized_path = _normalize_path(filepath)
-        if normalized_path in self._mappings:
-            return self._mappings[normalized_path].open(mode)
-        for regex in self._regexes:
-            if regex.match(normalized_path):
-                self.create_file(normalized_path, 'rw')
-                return self._mappings[normalized_path].open(mode)
+        fileobj = self._lookup(normalized_path)
+        if fileobj is None and self._overlays:
+            fileobj = self._create_in_overlay(normalized_path, mode)
+        if fileobj is not None:
+            return fileobj.open(mode)
+        if self._miss_handler is not None:
+            self._miss_handler(filepath, mode)
         return self._saved_open(filepath, mode, buffering)
 
     def _fake_io_open(self, filepath, mode='r', buffering=-1, encoding=None,
                       errors=None, newline=None, closefd=True):
-        LOGGER.info("Open file %s in mode %s with buffering %d, encoding %s "
-                    "errors %s, newline %s and closefd %s" %
-                    (filepath, mode, buffering, encoding, errors, newline,
-                     closefd))
+        if self._log_opens:
+            LOGGER.info("Open file %s in mode %s with buffering %d, encoding "
+                        "%s errors %s, newline %s and closefd %s",
+                        filepath, mode, buffering, encoding, errors, newline,
+                        closefd)
+        if not self._filter.may_match(filepath):
+            if self._miss_handler is not None and \
+                    isinstance(filepath, basestring):
+                self._miss_handler(filepath, mode)
+            return self._saved_io_open(filepath, mode, buffering, encoding,
+                                       errors, newline, closefd)
         normalized_path = _normalize_path(filepath)
-        if normalized_path in self._mappings:
-            return self._mappings[normalized_path].io_open(mode, encoding)
-        for regex in self._regexes:
-            if regex.match(normalized_path):
-                self.create_file(normalized_path, 'rw')
-                return self._mappings[normalized_path].io_open(mode, encoding)
+        fileobj = self._lookup(normalized_path)
+        if fileobj is None and self._overlays:
+            fileobj = self._create_in_overlay(normalized_path, mode)
+        if fileobj is not None:
+            return fileobj.io_open(mode, encoding, errors, newline)
+        if self._miss_handler is not None:
+            self._miss_handler(filepath, mode)
         return self._saved_io_open(filepath, mode, buffering, encoding,
                                    errors, newline, closefd)
 
+    def _fake_exists(self, path):
+        if self._lookup_path(path) is not None:
+            return True
+        return self._saved['_fake_exists'](path)
+
+    def _fake_isfile(self, path):
+        if isinstance(self._lookup_path(path), FakeIOFile):
+            return True
+        return self._saved['_fake_isfile'](path)
+
+    def _fake_isdir(self, path):
+        if isinstance(self._lookup_path(path), _Directory):
+            return True
+        return self._saved['_fake_isdir'](path)
+
+    def _fake_listdir(self, path):
+        # os.walk lists directories through os.listdir and os.path.isdir, so
+        # it walks faked directories as well.
+        found = self._lookup_path(path)
+        if not isinstance(found, _Directory):
+            return self._saved['_fake_listdir'](path)
+        names = set(found.dirs)
+        names.update(found.files)
+        try:
+            # The saved os.path.isdir would ask the faked os.stat.
+            real_dir = stat.S_ISDIR(self._saved['_fake_stat'](path).st_mode)
+        except OSError:
+            real_dir = False
+        if real_dir:
+            names.update(self._saved['_fake_listdir'](path))
+        return sorted(names)
+
+    def _fake_stat(self, path):
+        found = self._lookup_path(path)
+        if found is None:
+            return self._saved['_fake_stat'](path)
+        if isinstance(found, _Directory):
+            return os.stat_result((stat.S_IFDIR | 0o755, 0, 0, 1, 0, 0, 0,
+                                   0, 0, 0))
+        if found._mode == 'rw':
+            permission = 0o644
+        else:
+            permission = 0o444
+        mtime = found._mtime
+        return os.stat_result((stat.S_IFREG | permission, 0, 0, 1, 0, 0,
+                               found.size(), mtime, mtime, mtime))
+
+    def _fake_os_open(self, path, flags, mode=0o777):
+        # Only opening and closing need faking: reads, writes, seeks and
+        # mmap go to the real descriptor of the copy.
+        if not self._filter.may_match(path):
+            return self._saved['_fake_os_open'](path, flags, mode)
+        normalized_path = _normalize_path(path)
+        # Checked first, since looking a path up may create it.
+        exclusive = flags & os.O_CREAT and flags & os.O_EXCL
+        if exclusive and normalized_path in self._mappings:
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), path)
+        fileobj = self._lookup(normalized_path)
+        if fileobj is None and self._overlays and flags & os.O_CREAT:
+            fileobj = self._create_in_overlay(normalized_path, 'w')
+        if fileobj is None:
+            fd = self._saved['_fake_os_open'](path, flags, mode)
+            self._reap_descriptor(fd)
+            return fd
+        if exclusive and normalized_path in self._overlay_cache:
+            # Read through from an overlay, so it exists on disk.
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), path)
+        descriptor = fileobj._open_descriptor(flags)
+        self._reap_descriptor(descriptor.fd)
+        with self._lock:
+            descriptor._session = self
+            self._descriptors[descriptor.fd] = descriptor
+        return descriptor.fd
+
+    def _fake_os_close(self, fd):
+        if fd in self._descriptors:
+            with self._lock:
+                descriptor = self._descriptors.pop(fd, None)
+            if descriptor is not None:
+                if not descriptor.stale():
+                    return descriptor.close()
+                descriptor.release()
+        return self._saved['_fake_os_close'](fd)
+
+    def _fake_fstat(self, fd):
+        descriptor = self._reap_descriptor(fd)
+        result = self._saved['_fake_fstat'](fd)
+        if descriptor is None:
+            return result
+        found = descriptor._file
+        if found._mode == 'rw':
+            permission = 0o644
+        else:
+            permission = 0o444
+        mtime = found._mtime
+        return os.stat_result((stat.S_IFREG | permission, 0, 0, 1, 0, 0,
+                               result.st_size, mtime, mtime, mtime))
+
+    def _reap_descriptor(self, fd):
+        # Returns the live descriptor of the number. One closed elsewhere is
+        # released, as its number may now belong to another file.
+        descriptor = self._descriptors.get(fd)
+        if descriptor is not None and descriptor.stale():
+            descriptor.release()
+            return None
+        return descriptor
+
+    def _forget_descriptor(self, descriptor):
+        with self._lock:
+            if self._descriptors.get(descriptor.fd) is descriptor:
+                del self._descriptors[descriptor.fd]
+
+    def _lookup_path(self, path):
+        # An empty path would split to the root, yet names no file.
+        if not isinstance(path, basestring) or not path:
+            return None
+        normalized_path = _normalize_path(path)
+        fileobj = self._mappings.get(normalized_path)
+        if fileobj is not None:
+            return fileobj
+        return self._directories.directory(normalized_path)
+
     def __enter__(self):
         LOGGER.info("Fake __builtin__.open")
 
-        self._saved_open = __builtin__.open
-        self._saved_io_open = io.open
-        __builtin__.open = self._fake_open
-        io.open = self._fake_io_open
+        self._log_opens = LOGGER.isEnabledFor(logging.INFO)
+        # Found before the hooks are in place: the search opens files.
+        tempfile.gettempdir()
+        if self._scope == 'thread':
+            _THREAD_DISPATCHER.push(self)
+            self._saved = _THREAD_DISPATCHER.saved
+        else:
+            self._saved = dict((method, getattr(module, name))
+                               for module, name, method in _HOOKS)
+            for module, name, method in _HOOKS:
+                setattr(module, name, getattr(self, method))
+        self._saved_open = self._saved['_fake_open']
+        self._saved_io_open = self._saved['_fake_io_open']
 
     def __exit__(self, exc_type, exc_value, traceback):
         LOGGER.info("Restore __builtin__.open")
 
-        io.open = self._saved_io_open
-        __builtin__.open = self._saved_open
+        if self._scope == 'thread':
+            # Other threads may still be in this session.
+            _THREAD_DISPATCHER.pop(self)
+            return
+        for module, name, method in _HOOKS:
+            setattr(module, name, self._saved[method])
+        self._saved = dict()
         self._saved_io_open = None
         self._saved_open = None
+        self._log_opens = False
+
+def _sizeof(content):
+    if isinstance(content, basestring):
+        return sys.getsizeof(content)
+    if isinstance(content, (_Rope, _CompressedContent)):
+        return content.nbytes
+    return 0
+
+def _split_path(path):
+    # Absolute paths start with an empty part, so that "/a" and "a" differ.
+    parts = path.split('/')
+    return parts[:1] + [part for part in parts[1:] if part and part != '.']
 
 def _normalize_path(path):
     return path.replace("\\", "/")
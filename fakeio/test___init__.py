@@ -2,9 +2,20 @@
 # vim: fileencoding=utf-8
 from __future__ import (unicode_literals, print_function, absolute_import)
 import unittest
+import multiprocessing
+import pickle
+import json
 import fakeio
 import re
+import threading
+import tempfile
+import tarfile
+import zipfile
+import shutil
+import stat
 import io
+import os
+import errno
 import __builtin__
 
 class FakeIOSessionTest(unittest.TestCase):
@@ -137,6 +148,42 @@ class FakeIOSessionTest(unittest.TestCase):
         self.assertIn(filepath_mapping, mappings)
         self.assertIs(mappings[filepath_mapping], readable_fileobj)
 
+    def test_should_keep_mappings_view_live(self):
+        fakeio_session = fakeio.FakeIOSession()
+        mappings = fakeio_session.mappings
+        fakeio_session.create_file("/memfile/b.txt", 'r', b'')
+        fakeio_session.create_file("/memfile/a.txt", 'r', b'')
+        self.assertEqual(list(mappings), ["/memfile/a.txt", "/memfile/b.txt"])
+        self.assertEqual(len(mappings), 2)
+        with self.assertRaises(TypeError):
+            mappings["/memfile/c.txt"] = None
+
+    def test_should_query_paths_by_prefix_glob_and_marker(self):
+        fakeio_session = fakeio.FakeIOSession()
+        fakeio_session.intercept_regex(re.compile("^/memfile/"))
+        for filepath in ("/out/a.txt", "/out/b.log", "/out/sub/c.txt",
+                         "/outer.txt"):
+            fakeio_session.create_file(filepath, 'rw', b'')
+        snapshot = fakeio_session.snapshot()
+        marker = fakeio_session.marker()
+        with fakeio_session:
+            open("/memfile/new.txt", 'w').close()
+            with open("/out/b.log", 'w') as fileobj:
+                fileobj.write(b'changed')
+        self.assertEqual(fakeio_session.paths_with_prefix("/out/"),
+                         ["/out/a.txt", "/out/b.log", "/out/sub/c.txt"])
+        self.assertEqual(fakeio_session.glob("/out/*.txt"), ["/out/a.txt"])
+        self.assertEqual(fakeio_session.glob("/*/*/?.txt"),
+                         ["/out/sub/c.txt"])
+        self.assertEqual(fakeio_session.changed_since(marker),
+                         ["/memfile/new.txt", "/out/b.log"])
+        self.assertEqual(
+            fakeio_session.changed_since(fakeio_session.marker()), [])
+        # Restoring the older content is a change too
+        marker = fakeio_session.marker()
+        fakeio_session.restore(snapshot)
+        self.assertEqual(fakeio_session.changed_since(marker), ["/out/b.log"])
+
     def test_should_mapping_have_precedence_over_regex(self):
         fakeio_session = fakeio.FakeIOSession()
         filepath = "/memfile/something.txt"
@@ -207,6 +254,1095 @@ class FakeIOSessionTest(unittest.TestCase):
             # Assert not raise IOError
             open("/memfile\\something.txt", 'w')
 
+    def test_should_pass_through_file_descriptor(self):
+        fakeio_session = fakeio.FakeIOSession()
+        fakeio_session.create_file("/memfile/something.txt", 'r', 'content')
+        fd = os.open(__file__, os.O_RDONLY)
+
+        with fakeio_session:
+            with io.open(fd, 'rb') as fileobj:
+                self.assertEqual(fileobj.read(), open(__file__, 'rb').read())
+
+    def test_should_not_normalize_path_out_of_registered_prefixes(self):
+        filepath = "/other\\something.txt"
+        class OpenMock(object):
+            def __init__(self):
+                self.called = None
+
+            def __call__(self, f, m, b):
+                self.called = f
+        open_mock = OpenMock()
+        saved_open = __builtin__.open
+        try:
+            __builtin__.open = open_mock
+
+            fakeio_session = fakeio.FakeIOSession()
+            fakeio_session.create_file("/memfile/something.txt", 'r', '')
+            fakeio_session.intercept_regex(re.compile("^/memfile/"))
+            with fakeio_session:
+                open(filepath)
+            self.assertEqual(filepath, open_mock.called)
+        finally:
+            __builtin__.open = saved_open
+
+class ThreadSafetyTest(unittest.TestCase):
+
+    def test_should_scope_session_to_entering_thread(self):
+        filepath = "/memfile/something.txt"
+        saved_open = __builtin__.open
+        entered = [threading.Event(), threading.Event()]
+        results = dict()
+
+        def run(index):
+            fakeio_session = fakeio.FakeIOSession(scope='thread')
+            fakeio_session.create_file(filepath, 'r', 'content%d' % index)
+            with fakeio_session:
+                entered[index].set()
+                entered[1 - index].wait()
+                results[index] = open(filepath, 'r').read()
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        entered[0].wait()
+        with self.assertRaises(IOError):
+            open(filepath, 'r')
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {0: 'content0', 1: 'content1'})
+        self.assertIs(__builtin__.open, saved_open)
+
+    def test_should_nest_thread_scoped_sessions(self):
+        outer = fakeio.FakeIOSession(scope='thread')
+        inner = fakeio.FakeIOSession(scope='thread')
+        outer.create_file("/memfile/something.txt", 'r', 'outer')
+        inner.create_file("/memfile/something.txt", 'r', 'inner')
+        with outer:
+            with inner:
+                self.assertEqual(open("/memfile/something.txt").read(), 'inner')
+            self.assertEqual(open("/memfile/something.txt").read(), 'outer')
+
+    def test_should_create_regex_file_once_across_threads(self):
+        fakeio_session = fakeio.FakeIOSession()
+        fakeio_session.intercept_regex(re.compile("^/memfile/"))
+        errors = []
+
+        def run():
+            try:
+                for i in range(100):
+                    open("/memfile/%d.txt" % i, 'r').close()
+            except Exception as e:
+                errors.append(e)
+
+        with fakeio_session:
+            threads = [threading.Thread(target=run) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(fakeio_session.mappings), 100)
+
+    def test_should_not_lose_concurrent_appends(self):
+        fileobj = fakeio.FakeIOFile("/memfile/app.log", 'rw', b'')
+
+        def run():
+            for _ in range(300):
+                while True:
+                    try:
+                        writer = fileobj.open('a')
+                    except IOError:
+                        continue
+                    writer.write(b'x')
+                    writer.close()
+                    break
+
+        threads = [threading.Thread(target=run) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(fileobj.getvalue()), 2400)
+
+    def test_should_reject_unknown_scope(self):
+        with self.assertRaises(ValueError):
+            fakeio.FakeIOSession(scope='process')
+
+class AsyncOpenTest(unittest.TestCase):
+
+    class RecordingExecutor(object):
+        def __init__(self):
+            self.submitted = 0
+
+        def submit(self, func, *args):
+            self.submitted += 1
+            return fakeio._Future.call(func, *args)
+
+    def test_should_complete_fake_file_without_executor(self):
+        fakeio_session = fakeio.FakeIOSession()
+        fakeio_session.create_file("/memfile/something.txt", 'r', "a\nb\n")
+        executor = self.RecordingExecutor()
+
+        future = fakeio_session.async_open("/memfile/something.txt",
+                                           executor=executor)
+        self.assertTrue(future.done())
+        with future.result() as fileobj:
+            line = fileobj.readline()
+            self.assertTrue(line.done())
+            self.assertEqual(line.result(), "a\n")
+            self.assertEqual(fileobj.read().result(), "b\n")
+        self.assertEqual(executor.submitted, 0)
+
+    def test_should_iterate_lines_as_futures(self):
+        fakeio_session = fakeio.FakeIOSession()
+        fakeio_session.create_file("/memfile/something.txt", 'r', "a\n" * 10)
+        with fakeio_session:
+            real = fakeio_session.async_open(__file__, 'rb').result(10)
+            self.assertEqual(
+                [line for batch in real for line in batch.result(10)],
+                open(__file__, 'rb').readlines())
+            real.close().result(10)
+        with fakeio_session.async_open("/memfile/something.txt").result() \
+                as fileobj:
+            batches = [batch.result() for batch in fileobj.iterlines(4)]
+        self.assertEqual(batches[-1], [])
+        self.assertEqual(sum(batches, []), ["a\n"] * 10)
+        self.assertGreater(len(batches), 2)
+
+    def test_should_write_fake_file(self):
+        fakeio_session = fakeio.FakeIOSession()
+        file = fakeio_session.create_file("/memfile/something.txt", 'rw')
+
+        fileobj = fakeio_session.async_open("/memfile/something.txt",
+                                            'w').result()
+        fileobj.write("something").result()
+        fileobj.close().result()
+        self.assertEqual(file.getvalue(), "something")
+
+    def test_should_set_exception_of_fake_file(self):
+        fakeio_session = fakeio.FakeIOSession()
+        fakeio_session.create_file("/memfile/something.txt", 'r')
+
+        future = fakeio_session.async_open("/memfile/something.txt", 'w')
+        self.assertIsInstance(future.exception(), ValueError)
+
+    def test_should_delegate_real_file_to_executor(self):
+        fakeio_session = fakeio.FakeIOSession()
+        fakeio_session.create_file("/memfile/something.txt", 'r')
+        executor = self.RecordingExecutor()
+
+        with fakeio_session:
+            fileobj = fakeio_session.async_open(__file__, 'rb',
+                                                executor=executor).result()
+            content = fileobj.read().result()
+            fileobj.close().result()
+        self.assertEqual(content, open(__file__, 'rb').read())
+        self.assertEqual(executor.submitted, 3)
+
+    def test_should_run_real_file_in_thread_without_executor(self):
+        fakeio_session = fakeio.FakeIOSession()
+        future = fakeio_session.async_open(__file__, 'rb')
+        with future.result(10) as fileobj:
+            self.assertEqual(fileobj.read().result(10),
+                             open(__file__, 'rb').read())
+
+class ProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fakeio_session = fakeio.FakeIOSession()
+        self.fakeio_session.create_file("/memfile/a.txt", 'rw', b'a' * 100)
+        self.fakeio_session.create_file("/slow/b.txt", 'rw', b'b' * 100)
+
+    def test_should_charge_latency_and_bandwidth_to_clock(self):
+        self.fakeio_session.set_profile(fakeio.StorageProfile(
+            open_latency=0.5, call_latency=0.25, read_bandwidth=100,
+            write_bandwidth=50))
+        clock = self.fakeio_session.clock
+        with self.fakeio_session:
+            with open("/memfile/a.txt") as fileobj:
+                self.assertEqual(clock.time(), 0.5)
+                fileobj.read()
+                self.assertEqual(clock.time(), 1.75)
+            with io.open("/memfile/a.txt", 'wb') as fileobj:
+                fileobj.write(b'x' * 25)
+            self.assertEqual(clock.time(), 3.0)
+
+    def test_should_prefer_profiles_of_regexes(self):
+        self.fakeio_session.set_profile(
+            fakeio.StorageProfile(open_latency=1.0))
+        self.fakeio_session.set_profile(
+            fakeio.StorageProfile(open_latency=10.0), "^/slow/")
+        with self.fakeio_session:
+            open("/memfile/a.txt").close()
+            open("/slow/b.txt").close()
+        self.assertEqual(self.fakeio_session.clock.time(), 11.0)
+
+    def test_should_use_plain_files_without_profile(self):
+        profile = fakeio.StorageProfile(open_latency=1.0)
+        self.fakeio_session.set_profile(profile, "^/slow/")
+        self.fakeio_session.set_profile(None, "^/slow/")
+        with self.fakeio_session:
+            with open("/slow/b.txt") as fileobj:
+                self.assertIs(type(fileobj), fakeio.ReadOpenedFakeIOFile)
+        self.assertEqual(self.fakeio_session.clock.time(), 0.0)
+
+class MemoryBudgetTest(unittest.TestCase):
+
+    def test_should_account_memory_of_files(self):
+        fakeio_session = fakeio.FakeIOSession()
+        first = fakeio_session.create_file("/memfile/a.txt", 'r', b'a' * 1000)
+        second = fakeio_session.create_file("/memfile/b.txt", 'r', b'b' * 2000)
+        self.assertGreaterEqual(first.memory_usage(), 1000)
+        self.assertGreaterEqual(second.memory_usage(), 2000)
+        self.assertEqual(fakeio_session.memory_usage(),
+                         first.memory_usage() + second.memory_usage())
+
+    def test_should_not_account_replaced_file(self):
+        fakeio_session = fakeio.FakeIOSession()
+        fakeio_session.create_file("/memfile/a.txt", 'r', b'a' * 1000)
+        fileobj = fakeio_session.create_file("/memfile/a.txt", 'r', b'a')
+        self.assertEqual(fakeio_session.memory_usage(), fileobj.memory_usage())
+
+    def test_should_spill_least_recently_used_files(self):
+        fakeio_session = fakeio.FakeIOSession(memory_budget=5000)
+        files = [fakeio_session.create_file("/memfile/%d.txt" % i, 'r',
+                                            str(i) * 2000)
+                 for i in range(5)]
+        self.assertLessEqual(fakeio_session.memory_usage(), 5000)
+        self.assertEqual(files[0].memory_usage(), 0)
+        self.assertGreater(files[4].memory_usage(), 0)
+        stats = fakeio_session.memory_stats()
+        self.assertEqual(stats['spilled_files'], 3)
+        self.assertEqual(stats['spilled_bytes'], 6000)
+
+    def test_should_load_spilled_file_on_open(self):
+        fakeio_session = fakeio.FakeIOSession(memory_budget=3000)
+        for i in range(5):
+            fakeio_session.create_file("/memfile/%d.txt" % i, 'rw',
+                                       str(i) * 2000)
+        with fakeio_session:
+            with open("/memfile/0.txt", 'r') as fileobj:
+                self.assertEqual(fileobj.read(), '0' * 2000)
+            with open("/memfile/1.txt", 'a') as fileobj:
+                fileobj.write(b'1')
+        self.assertEqual(fakeio_session.mappings["/memfile/1.txt"].getvalue(),
+                         '1' * 2001)
+        self.assertLessEqual(fakeio_session.memory_usage(), 3000)
+
+    def test_should_load_spilled_unicode_file(self):
+        fakeio_session = fakeio.FakeIOSession(memory_budget=1)
+        first = fakeio_session.create_file("/memfile/a.txt", 'r', "あいうえお")
+        fakeio_session.create_file("/memfile/b.txt", 'r', "かきくけこ")
+        self.assertEqual(first.memory_usage(), 0)
+        self.assertEqual(first.getvalue(), "あいうえお")
+
+    def test_should_spill_largest_files(self):
+        fakeio_session = fakeio.FakeIOSession(memory_budget=5000,
+                                              spill_policy='largest')
+        large = fakeio_session.create_file("/memfile/a.txt", 'r', b'a' * 4000)
+        small = fakeio_session.create_file("/memfile/b.txt", 'r', b'b' * 100)
+        fakeio_session.create_file("/memfile/c.txt", 'r', b'c' * 2000)
+        self.assertEqual(large.memory_usage(), 0)
+        self.assertGreater(small.memory_usage(), 0)
+
+    def test_should_not_spill_opened_file(self):
+        fakeio_session = fakeio.FakeIOSession(memory_budget=1)
+        fileobj = fakeio_session.create_file("/memfile/a.txt", 'r', b'a' * 100)
+        reader = fileobj.open('r')
+        fakeio_session.create_file("/memfile/b.txt", 'r', b'b' * 100)
+        self.assertGreater(fileobj.memory_usage(), 0)
+        self.assertEqual(reader.read(), b'a' * 100)
+
+    def test_should_reuse_released_spill_space(self):
+        store = fakeio._SpillStore()
+        offsets = [store.put(b'%d' % i * 100) for i in range(3)]
+        store.release(offsets[1], 100)
+        self.assertEqual(store.put(b'x' * 60), offsets[1])
+        self.assertEqual(store.get(offsets[2], 3), b'222')
+        store.release(offsets[2], 100)
+        self.assertEqual(store._size, 160)
+        store.release(offsets[1], 60)
+        self.assertEqual(store._size, 100)
+        store.release(offsets[0], 100)
+        self.assertEqual((store._size, store._free, store.nbytes), (0, [], 0))
+
+    def test_should_compress_idle_files(self):
+        fakeio_session = fakeio.FakeIOSession(compression='zlib',
+                                              compress_after=0)
+        text = fakeio_session.create_file("/memfile/a.txt", 'r', "あ" * 1000)
+        log = fakeio_session.create_file("/memfile/b.log", 'rw', b'')
+        small = fakeio_session.create_file("/memfile/c.txt", 'r', b'c')
+        with fakeio_session:
+            with open("/memfile/b.log", 'a') as fileobj:
+                fileobj.write(b'line\n' * 1000)
+            fakeio_session.compress_idle()
+            self.assertLess(log.memory_usage(), 100)
+            with open("/memfile/b.log", 'a') as fileobj:
+                fileobj.write(b'last\n')
+        fakeio_session.compress_idle()
+        stats = fakeio_session.memory_stats()
+        self.assertEqual(stats['compressed_files'], 2)
+        self.assertEqual(stats['uncompressed_bytes'], 8005)
+        self.assertLess(stats['compressed_bytes'], 200)
+        self.assertEqual(fakeio_session.memory_usage(),
+                         text.memory_usage() + log.memory_usage() +
+                         small.memory_usage())
+        self.assertTrue(text.getvalue() == "あ" * 1000)
+        self.assertTrue(log.getvalue() == b'line\n' * 1000 + b'last\n')
+
+    def test_should_not_compress_recently_closed_files(self):
+        fakeio_session = fakeio.FakeIOSession(compression='bz2',
+                                              compress_after=3600)
+        fakeio_session.create_file("/memfile/a.txt", 'r', b'a' * 1000)
+        fakeio_session.compress_idle()
+        self.assertEqual(fakeio_session.memory_stats()['compressed_files'], 0)
+        self.assertRaises(ValueError, fakeio.FakeIOSession,
+                          compression='lzma')
+
+class SnapshotTest(unittest.TestCase):
+
+    def write(self, filepath, content, mode='w'):
+        with open(filepath, mode) as fileobj:
+            fileobj.write(content)
+
+    def test_should_restore_written_file(self):
+        fakeio_session = fakeio.FakeIOSession()
+        file = fakeio_session.create_file("/memfile/a.txt", 'rw', b'original')
+        snapshot = fakeio_session.snapshot()
+        with fakeio_session:
+            self.write("/memfile/a.txt", b'changed')
+        fakeio_session.restore(snapshot)
+        self.assertIs(fakeio_session.mappings["/memfile/a.txt"], file)
+        self.assertEqual(file.getvalue(), b'original')
+
+    def test_should_remove_files_created_after_snapshot(self):
+        fakeio_session = fakeio.FakeIOSession()
+        fakeio_session.intercept_regex(re.compile("^/memfile/"))
+        fakeio_session.create_file("/memfile/a.txt", 'rw', b'a')
+        snapshot = fakeio_session.snapshot()
+        with fakeio_session:
+            self.write("/memfile/b.txt", b'b')
+        fakeio_session.create_file("/memfile/a.txt", 'rw', b'replaced')
+        fakeio_session.restore(snapshot)
+        self.assertEqual(sorted(fakeio_session.mappings), ["/memfile/a.txt"])
+        self.assertEqual(fakeio_session.mappings["/memfile/a.txt"].getvalue(),
+                         b'a')
+
+    def test_should_restore_snapshot_many_times(self):
+        fakeio_session = fakeio.FakeIOSession()
+        file = fakeio_session.create_file("/memfile/a.txt", 'rw', b'some')
+        snapshot = fakeio_session.snapshot()
+        with fakeio_session:
+            for _ in range(3):
+                self.write("/memfile/a.txt", b'thing', 'a')
+                self.assertEqual(file.getvalue(), b'something')
+                fakeio_session.restore(snapshot)
+                self.assertEqual(file.getvalue(), b'some')
+
+    def test_should_not_grow_journal_with_restores(self):
+        fakeio_session = fakeio.FakeIOSession()
+        for i in range(5):
+            fakeio_session.create_file("/memfile/%d.txt" % i, 'rw', b'')
+        baseline = fakeio_session.snapshot()
+        older = fakeio_session.snapshot()
+        with fakeio_session:
+            for _ in range(50):
+                for i in range(5):
+                    self.write("/memfile/%d.txt" % i, b'changed')
+                fakeio_session.restore(baseline)
+            self.write("/memfile/0.txt", b'newer')
+            newer = fakeio_session.snapshot()
+        self.assertLessEqual(len(fakeio_session._journal), 6)
+        fakeio_session.restore(older)
+        fakeio_session.restore(newer)
+        self.assertEqual(fakeio_session.mappings["/memfile/0.txt"].getvalue(),
+                         b'newer')
+        fakeio_session.restore(baseline)
+        self.assertEqual(fakeio_session.mappings["/memfile/0.txt"].getvalue(),
+                         b'')
+
+    def test_should_restore_older_snapshot_after_newer_one(self):
+        fakeio_session = fakeio.FakeIOSession()
+        file = fakeio_session.create_file("/memfile/a.txt", 'rw', b'first')
+        first = fakeio_session.snapshot()
+        with fakeio_session:
+            self.write("/memfile/a.txt", b'second')
+            second = fakeio_session.snapshot()
+            self.write("/memfile/a.txt", b'third')
+        fakeio_session.restore(first)
+        self.assertEqual(file.getvalue(), b'first')
+        fakeio_session.restore(second)
+        self.assertEqual(file.getvalue(), b'second')
+        fakeio_session.restore(first)
+        self.assertEqual(file.getvalue(), b'first')
+
+    def test_should_restore_spilled_file(self):
+        fakeio_session = fakeio.FakeIOSession(memory_budget=1)
+        file = fakeio_session.create_file("/memfile/a.txt", 'rw', b'a' * 100)
+        fakeio_session.create_file("/memfile/b.txt", 'rw', b'b' * 100)
+        snapshot = fakeio_session.snapshot()
+        with fakeio_session:
+            self.write("/memfile/a.txt", b'changed')
+            self.write("/memfile/b.txt", b'changed')
+        fakeio_session.restore(snapshot)
+        self.assertEqual(file.getvalue(), b'a' * 100)
+        self.assertEqual(fakeio_session.mappings["/memfile/b.txt"].getvalue(),
+                         b'b' * 100)
+
+    def test_should_reject_snapshot_of_another_session(self):
+        snapshot = fakeio.FakeIOSession().snapshot()
+        with self.assertRaises(ValueError):
+            fakeio.FakeIOSession().restore(snapshot)
+
+    def test_should_clone_independent_session(self):
+        fakeio_session = fakeio.FakeIOSession()
+        fakeio_session.intercept_regex(re.compile("^/memfile/"))
+        file = fakeio_session.create_file("/memfile/a.txt", 'rw', b'original')
+        cloned = fakeio_session.clone()
+        with cloned:
+            self.write("/memfile/a.txt", b'changed')
+            self.write("/memfile/b.txt", b'created')
+        self.assertEqual(file.getvalue(), b'original')
+        self.assertEqual(cloned.mappings["/memfile/a.txt"].getvalue(),
+                         b'changed')
+        self.assertNotIn("/memfile/b.txt", fakeio_session.mappings)
+        self.assertEqual(cloned.memory_usage(), sum(
+            fileobj.memory_usage() for fileobj in cloned.mappings.values()))
+
+class MountTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dirpath, "sub"))
+        for name, content in [("a.txt", b'a'), ("sub/b.txt", b'b')]:
+            with open(os.path.join(self.dirpath, name), 'wb') as fileobj:
+                fileobj.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def test_should_mount_directory(self):
+        fakeio_session = fakeio.FakeIOSession()
+        count = fakeio_session.mount_directory(self.dirpath, "/fixture/")
+        self.assertEqual(count, 2)
+        with fakeio_session:
+            self.assertEqual(open("/fixture/a.txt").read(), b'a')
+            self.assertEqual(open("/fixture/sub/b.txt").read(), b'b')
+
+    def test_should_read_directory_file_when_opened(self):
+        fakeio_session = fakeio.FakeIOSession()
+        fakeio_session.mount_directory(self.dirpath, "/fixture")
+        self.assertEqual(fakeio_session.memory_usage(), 0)
+        with open(os.path.join(self.dirpath, "a.txt"), 'wb') as fileobj:
+            fileobj.write(b'changed')
+        with fakeio_session:
+            self.assertEqual(open("/fixture/a.txt").read(), b'changed')
+        self.assertGreater(fakeio_session.memory_usage(), 0)
+
+    def test_should_mount_tar(self):
+        archivepath = os.path.join(self.dirpath, "fixture.tar.gz")
+        with tarfile.open(archivepath, 'w:gz') as archive:
+            archive.add(os.path.join(self.dirpath, "a.txt"), "a.txt")
+            archive.add(os.path.join(self.dirpath, "sub"), "sub")
+        fakeio_session = fakeio.FakeIOSession()
+        self.assertEqual(fakeio_session.mount_tar(archivepath, "/fixture"), 2)
+        with fakeio_session:
+            self.assertEqual(open("/fixture/sub/b.txt").read(), b'b')
+            self.assertEqual(open("/fixture/a.txt").read(), b'a')
+
+    def test_should_mount_zip(self):
+        archivepath = os.path.join(self.dirpath, "fixture.zip")
+        archive = zipfile.ZipFile(archivepath, 'w')
+        archive.writestr("a.txt", b'a')
+        archive.writestr("sub/", b'')
+        archive.writestr("sub/b.txt", b'b')
+        archive.close()
+        fakeio_session = fakeio.FakeIOSession()
+        self.assertEqual(fakeio_session.mount_zip(archivepath, "/fixture"), 2)
+        with fakeio_session:
+            self.assertEqual(io.open("/fixture/sub/b.txt").read(), "b")
+
+    @unittest.skipUnless(os.path.isdir("/proc/self/fd"), "needs /proc")
+    def test_should_not_keep_archives_open(self):
+        archivepath = os.path.join(self.dirpath, "fixture.zip")
+        with zipfile.ZipFile(archivepath, 'w') as archive:
+            archive.writestr("a.txt", b'a')
+        with tarfile.open(archivepath + ".tar", 'w') as archive:
+            archive.add(os.path.join(self.dirpath, "a.txt"), "a.txt")
+        descriptors = len(os.listdir("/proc/self/fd"))
+        fakeio_session = fakeio.FakeIOSession()
+        fakeio_session.mount_zip(archivepath, "/zip")
+        fakeio_session.mount_tar(archivepath + ".tar", "/tar")
+        self.assertEqual(fakeio_session.mappings["/zip/a.txt"].getvalue(), b'a')
+        self.assertEqual(fakeio_session.mappings["/tar/a.txt"].getvalue(), b'a')
+        self.assertEqual(len(os.listdir("/proc/self/fd")), descriptors)
+
+    def test_should_drop_unchanged_mounted_file_instead_of_spilling(self):
+        fakeio_session = fakeio.FakeIOSession(memory_budget=1)
+        fakeio_session.mount_directory(self.dirpath, "/fixture", mode='rw')
+        with fakeio_session:
+            for filepath in ["/fixture/a.txt", "/fixture/sub/b.txt"]:
+                with open(filepath) as fileobj:
+                    fileobj.read()
+            with open("/fixture/sub/b.txt", 'a') as fileobj:
+                fileobj.write(b'c')
+            with open("/fixture/a.txt") as fileobj:
+                self.assertEqual(fileobj.read(), b'a')
+        self.assertEqual(fakeio_session.memory_stats()['spilled_files'], 1)
+        self.assertEqual(fakeio_session.mappings["/fixture/sub/b.txt"]
+                         .getvalue(), b'bc')
+
+class StatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fakeio_session = fakeio.FakeIOSession(collect_stats=True)
+        self.fakeio_session.create_file("/memfile/a.txt", 'rw', b'a\nb\n')
+
+    def test_should_count_reads_and_writes(self):
+        with self.fakeio_session:
+            with open("/memfile/a.txt") as fileobj:
+                self.assertEqual(fileobj.readline(), b'a\n')
+                self.assertEqual(fileobj.read(), b'b\n')
+            with open("/memfile/a.txt", 'a') as fileobj:
+                fileobj.write(b'c\n')
+                fileobj.writelines([b'd\n', b'e' * 100])
+        stats = self.fakeio_session.stats()
+        self.assertEqual(stats['total'], stats['files']["/memfile/a.txt"])
+        self.assertEqual(stats['total']['opens'], 2)
+        self.assertEqual(stats['total']['reads'], 2)
+        self.assertEqual(stats['total']['bytes_read'], 4)
+        self.assertEqual(stats['total']['writes'], 3)
+        self.assertEqual(stats['total']['bytes_written'], 104)
+        self.assertEqual(stats['total']['write_sizes'], {2: 2, 128: 1})
+
+    def test_should_count_io_open(self):
+        self.fakeio_session.create_file("/memfile/b.txt", 'rw', b'')
+        with self.fakeio_session:
+            with io.open("/memfile/b.txt", 'w') as fileobj:
+                fileobj.write("x")
+            with io.open("/memfile/b.txt") as fileobj:
+                self.assertEqual(list(fileobj), ["x"])
+        stats = self.fakeio_session.stats()
+        self.assertEqual(stats['files']["/memfile/b.txt"]['writes'], 1)
+        self.assertEqual(stats['files']["/memfile/b.txt"]['reads'], 2)
+        self.assertEqual(stats['total']['opens'], 2)
+
+    def test_should_export_json(self):
+        with self.fakeio_session:
+            open("/memfile/a.txt").close()
+        stats = json.loads(self.fakeio_session.stats_json())
+        self.assertEqual(stats['files']["/memfile/a.txt"]['opens'], 1)
+
+    def test_should_not_count_by_default(self):
+        fakeio_session = fakeio.FakeIOSession()
+        fakeio_session.create_file("/memfile/a.txt", 'r', b'a')
+        with fakeio_session:
+            fileobj = open("/memfile/a.txt")
+            self.assertEqual(type(fileobj), fakeio.ReadOpenedFakeIOFile)
+            fileobj.close()
+        self.assertEqual(fakeio_session.stats(), {'files': {}, 'total': {}})
+
+def _append_in_shared_session(share):
+    with share.session():
+        with open("/memfile/a.txt") as fileobj:
+            content = fileobj.read()
+        with open("/memfile/a.txt", 'w') as fileobj:
+            fileobj.write(content + b'b')
+        with open("/memfile/new.txt", 'w') as fileobj:
+            fileobj.write(b'new')
+
+class ShareTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fakeio_session = fakeio.FakeIOSession()
+        self.fakeio_session.create_file("/memfile/a.txt", 'rw', b'a')
+        self.fakeio_session.intercept_regex(re.compile("^/memfile/new"))
+        self.share = self.fakeio_session.share()
+
+    def tearDown(self):
+        self.share.close()
+
+    def test_should_move_contents_out_of_memory(self):
+        self.assertEqual(self.fakeio_session.memory_usage(), 0)
+        self.assertEqual(len(os.listdir(self.share.dirpath)), 1)
+        with self.fakeio_session:
+            self.assertEqual(open("/memfile/a.txt").read(), b'a')
+
+    def test_should_see_writes_of_other_processes_after_sync(self):
+        process = multiprocessing.Process(target=_append_in_shared_session,
+                                          args=(self.share,))
+        process.start()
+        process.join()
+        self.assertEqual(self.share.sync(), 2)
+        mappings = self.fakeio_session.mappings
+        self.assertEqual(mappings["/memfile/a.txt"].getvalue(), b'ab')
+        self.assertEqual(mappings["/memfile/new.txt"].getvalue(), b'new')
+        self.assertEqual(self.share.sync(), 0)
+
+    def test_should_install_unpickled_share(self):
+        share = pickle.loads(pickle.dumps(self.share))
+        session = share.session()
+        self.assertIsNot(session, self.fakeio_session)
+        self.assertEqual(session.mappings["/memfile/a.txt"].getvalue(), b'a')
+        with session:
+            open("/memfile/new.txt", 'w').close()
+        self.assertIn("/memfile/new.txt", session.mappings)
+
+    def test_should_load_contents_back_when_closed(self):
+        self.share.close()
+        self.assertFalse(os.path.exists(self.share.dirpath))
+        self.assertEqual(
+            self.fakeio_session.mappings["/memfile/a.txt"].getvalue(), b'a')
+
+    def test_should_keep_text_contents_text(self):
+        fakeio_session = fakeio.FakeIOSession()
+        fakeio_session.create_file("/memfile/t.txt", 'rw', "héllo")
+        share = fakeio_session.share()
+        try:
+            other = pickle.loads(pickle.dumps(share)).session()
+            for session in (fakeio_session, other):
+                value = session.mappings["/memfile/t.txt"].getvalue()
+                self.assertEqual(value, "héllo")
+                self.assertIsInstance(value, unicode)
+        finally:
+            share.close()
+        value = fakeio_session.mappings["/memfile/t.txt"].getvalue()
+        self.assertIsInstance(value, unicode)
+        self.assertIsNone(fakeio_session.mappings["/memfile/t.txt"]._encoding)
+
+    def test_should_remove_segments_written_again(self):
+        def segments():
+            return [name for name in os.listdir(self.share.dirpath)
+                    if name[0].isdigit()]
+        synced = os.path.join(self.share.dirpath, 'synced-%d' % os.getppid())
+        with open(synced, 'w') as fileobj:
+            fileobj.write('0')
+        with self.fakeio_session:
+            for _ in range(5):
+                with open("/memfile/a.txt", 'a') as fileobj:
+                    fileobj.write(b'b')
+            # Kept for another process that has not synced yet
+            self.assertEqual(len(segments()), 6)
+            with open(synced, 'w') as fileobj:
+                fileobj.write(str(os.path.getsize(
+                    os.path.join(self.share.dirpath, 'journal'))))
+            with open("/memfile/a.txt", 'a') as fileobj:
+                fileobj.write(b'b')
+        # The segment of the index, the last one and the one before, which
+        # the other process may still read
+        self.assertEqual(len(segments()), 3)
+        with open(os.path.join(self.share.dirpath, 'journal')) as fileobj:
+            last = json.loads(fileobj.readlines()[-1])
+        self.assertIn(last[-2], segments())
+
+class ImageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fakeio_session = fakeio.FakeIOSession()
+        self.fakeio_session.create_file("/memfile/a.bin", 'r', b'a\x00b')
+        self.fakeio_session.create_file("/memfile/sub/b.txt", 'rw', "あい")
+        self.fakeio_session.create_file("/memfile/empty.txt", 'rw')
+        fd, self.imagepath = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.imagepath)
+
+    def test_should_load_saved_image(self):
+        self.assertEqual(self.fakeio_session.save_image(self.imagepath), 3)
+        fakeio_session = fakeio.FakeIOSession()
+        self.assertEqual(fakeio_session.load_image(self.imagepath), 3)
+        mappings = fakeio_session.mappings
+        self.assertEqual(mappings["/memfile/sub/b.txt"].getvalue(), "あい")
+        self.assertIsInstance(mappings["/memfile/sub/b.txt"].getvalue(),
+                              unicode)
+        self.assertIsInstance(mappings["/memfile/a.bin"].getvalue(), str)
+        with fakeio_session:
+            self.assertEqual(open("/memfile/a.bin").read(), b'a\x00b')
+            self.assertEqual(io.open("/memfile/sub/b.txt").read(), "あい")
+            self.assertEqual(open("/memfile/empty.txt").read(), b'')
+            self.assertEqual(os.listdir("/memfile"),
+                             ["a.bin", "empty.txt", "sub"])
+            self.assertRaises(ValueError, open, "/memfile/a.bin", 'w')
+
+    def test_should_load_contents_lazily(self):
+        self.fakeio_session.save_image(self.imagepath)
+        fakeio_session = fakeio.FakeIOSession()
+        fakeio_session.load_image(self.imagepath)
+        self.assertEqual(fakeio_session.memory_usage(), 0)
+        self.assertEqual(fakeio_session.mappings["/memfile/a.bin"].size(), 3)
+
+    def test_should_reject_other_files(self):
+        with open(self.imagepath, 'wb') as fileobj:
+            fileobj.write(b'not an image')
+        self.assertRaises(ValueError, fakeio.FakeIOSession().load_image,
+                          self.imagepath)
+
+class StreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fakeio_session = fakeio.FakeIOSession()
+
+    def test_should_read_lines_across_chunks(self):
+        self.fakeio_session.create_file(
+            "/memfile/a.txt", 'r', lambda: [b'ab', b'c\nd', b'', b'ef\n', b'g'])
+        with self.fakeio_session:
+            with open("/memfile/a.txt") as fileobj:
+                self.assertEqual(list(fileobj), [b'abc\n', b'def\n', b'g'])
+            with open("/memfile/a.txt") as fileobj:
+                self.assertEqual(fileobj.read(2), b'ab')
+                self.assertEqual(fileobj.readline(2), b'c\n')
+                self.assertEqual(fileobj.readline(), b'def\n')
+                fileobj.seek(1)
+                self.assertEqual(fileobj.read(), b'bc\ndef\ng')
+                self.assertEqual(fileobj.tell(), 9)
+
+    def test_should_read_across_many_small_chunks(self):
+        self.fakeio_session.create_file(
+            "/memfile/a.txt", 'r', lambda: (b'%d' % (i % 10)
+                                            for i in xrange(10000)))
+        with self.fakeio_session:
+            with open("/memfile/a.txt") as fileobj:
+                self.assertEqual(fileobj.read(15), b'012345678901234')
+                self.assertEqual(fileobj.readline(7), b'5678901')
+                fileobj.seek(9995)
+                self.assertEqual(fileobj.readline(), b'56789')
+                self.assertEqual(fileobj.read(1), b'')
+
+    def test_should_not_spill_unopened_stream(self):
+        pulled = []
+
+        def chunks():
+            pulled.append(True)
+            yield b'x' * 10000
+
+        fakeio_session = fakeio.FakeIOSession(memory_budget=10)
+        fakeio_session.create_file("/memfile/a.txt", 'r', chunks)
+        fakeio_session.create_file("/memfile/b.txt", 'r', b'b' * 100)
+        fakeio_session.create_file("/memfile/c.txt", 'r', b'c' * 100)
+        self.assertEqual(pulled, [])
+        self.assertEqual(fakeio_session.memory_stats()['spilled_bytes'], 100)
+
+    def test_should_pull_chunks_while_reading(self):
+        pulled = []
+
+        def chunks():
+            for i in xrange(3):
+                pulled.append(i)
+                yield b'%d\n' % i
+
+        self.fakeio_session.create_file("/memfile/a.txt", 'r', chunks)
+        with self.fakeio_session:
+            with open("/memfile/a.txt") as fileobj:
+                self.assertEqual(fileobj.readline(), b'0\n')
+                self.assertEqual(pulled, [0])
+
+    def test_should_read_iterables_once_unless_cached(self):
+        self.fakeio_session.create_file("/memfile/once.txt", 'r',
+                                        iter([b'a\n', b'b']))
+        self.fakeio_session.create_file("/memfile/cached.txt", 'r',
+                                        iter([b'a\n', b'b']), cache=True)
+        with self.fakeio_session:
+            self.assertEqual(open("/memfile/once.txt").read(), b'a\nb')
+            self.assertRaises(IOError, open, "/memfile/once.txt")
+            self.assertEqual(open("/memfile/cached.txt").read(), b'a\nb')
+            with open("/memfile/cached.txt") as fileobj:
+                self.assertEqual(fileobj.readlines(), [b'a\n', b'b'])
+                fileobj.seek(0)
+                self.assertEqual(fileobj.read(1), b'a')
+
+    def test_should_stat_streams(self):
+        pulled = []
+
+        def chunks():
+            pulled.append(True)
+            return [b'abc', b'def']
+
+        self.fakeio_session.create_file("/memfile/a.txt", 'r', chunks)
+        self.fakeio_session.create_file("/memfile/b.txt", 'r', chunks,
+                                        length=6)
+        self.fakeio_session.create_file("/memfile/once.txt", 'r',
+                                        iter(["あ", b'b']))
+        with self.fakeio_session:
+            self.assertEqual(os.stat("/memfile/b.txt").st_size, 6)
+            self.assertEqual(pulled, [])
+            self.assertEqual(os.path.getsize("/memfile/a.txt"), 6)
+            self.assertEqual(os.path.getsize("/memfile/once.txt"), 4)
+            self.assertEqual(open("/memfile/once.txt").read(),
+                             "あb".encode('utf8'))
+
+    def test_should_decode_characters_split_between_chunks(self):
+        encoded = "あい\n".encode('utf8')
+        file = fakeio.FakeIOFile("/memfile/a.txt", 'r', fakeio._StreamContent(
+            lambda: [encoded[:2], encoded[2:4], encoded[4:]]), 'utf8')
+        with file.io_open('r', None) as fileobj:
+            self.assertEqual(fileobj.read(), "あい\n")
+        self.assertEqual(file.getvalue(), encoded)
+
+class OverlayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.path = os.path.join(self.dirpath, "a.txt")
+        with open(self.path, 'wb') as fileobj:
+            fileobj.write(b'disk')
+        self.fakeio_session = fakeio.FakeIOSession(overlay_budget=8)
+        self.fakeio_session.overlay_directory(self.dirpath)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def write_disk(self, path, content):
+        with open(path, 'wb') as fileobj:
+            fileobj.write(content)
+
+    def test_should_read_through_once(self):
+        with self.fakeio_session:
+            self.assertEqual(open(self.path).read(), b'disk')
+            fileobj = self.fakeio_session.mappings[self.path]
+            self.assertEqual(open(self.path).read(), b'disk')
+            self.assertIs(self.fakeio_session.mappings[self.path], fileobj)
+
+    def test_should_read_again_when_changed_on_disk(self):
+        with self.fakeio_session:
+            self.assertEqual(open(self.path).read(), b'disk')
+        self.write_disk(self.path, b'changed')
+        with self.fakeio_session:
+            self.assertEqual(open(self.path).read(), b'changed')
+        os.remove(self.path)
+        with self.fakeio_session:
+            self.assertRaises(IOError, open, self.path)
+        self.assertNotIn(self.path, self.fakeio_session.mappings)
+
+    def test_should_keep_writes_in_memory(self):
+        new_path = os.path.join(self.dirpath, "new.txt")
+        with self.fakeio_session:
+            with open(self.path, 'a') as fileobj:
+                fileobj.write(b'+')
+            with open(new_path, 'w') as fileobj:
+                fileobj.write(b'new')
+            self.assertEqual(open(self.path).read(), b'disk+')
+            self.assertEqual(open(new_path).read(), b'new')
+        self.write_disk(self.path, b'changed')
+        with self.fakeio_session:
+            self.assertEqual(open(self.path).read(), b'disk+')
+        self.assertFalse(os.path.exists(new_path))
+
+    def test_should_evict_least_recently_used_copies(self):
+        other_path = os.path.join(self.dirpath, "b.txt")
+        self.write_disk(other_path, b'other')
+        with self.fakeio_session:
+            open(self.path).close()
+            open(other_path).close()
+        self.assertNotIn(self.path, self.fakeio_session.mappings)
+        self.assertIn(other_path, self.fakeio_session.mappings)
+
+class RecordTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.path = os.path.join(self.dirpath, "a.txt")
+        self.out_path = os.path.join(self.dirpath, "out.txt")
+        with open(self.path, 'wb') as fileobj:
+            fileobj.write(b'input')
+        self.fakeio_session = fakeio.FakeIOSession()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath, ignore_errors=True)
+
+    def run_job(self):
+        with open(self.path) as fileobj:
+            content = fileobj.read()
+        with io.open(self.out_path, 'wb') as fileobj:
+            fileobj.write(content.upper())
+
+    def test_should_record_real_files(self):
+        self.fakeio_session.start_recording()
+        with self.fakeio_session:
+            self.run_job()
+        replay = self.fakeio_session.stop_recording()
+        self.assertEqual(sorted(replay.mappings), [self.path, self.out_path])
+        self.assertEqual(replay.mappings[self.path].getvalue(), b'input')
+        shutil.rmtree(self.dirpath)
+        with replay:
+            self.run_job()
+            self.assertEqual(open(self.out_path).read(), b'INPUT')
+        self.assertEqual(replay.misses(), [])
+
+    def test_should_only_record_matching_paths(self):
+        self.fakeio_session.start_recording("^/nothing/")
+        with self.fakeio_session:
+            self.run_job()
+        self.assertEqual(self.fakeio_session.stop_recording().mappings, {})
+
+    def test_should_resume_tracking_misses_after_recording(self):
+        self.assertRaises(fakeio.ProgrammingException,
+                          self.fakeio_session.stop_recording)
+        self.fakeio_session.track_misses()
+        self.fakeio_session.start_recording()
+        self.fakeio_session.stop_recording()
+        with self.fakeio_session:
+            self.run_job()
+        self.assertEqual(self.fakeio_session.misses(),
+                         [self.path, self.out_path])
+
+    def test_should_report_unrecorded_paths(self):
+        replay = fakeio.FakeIOSession()
+        replay.track_misses()
+        with replay:
+            open(self.path).close()
+        self.assertEqual(replay.misses(), [self.path])
+        replay.track_misses(strict=True)
+        with replay:
+            self.assertRaises(IOError, open, self.path)
+
+class FakeOSTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fakeio_session = fakeio.FakeIOSession()
+        self.fakeio_session.create_file("/memfile/a.txt", 'r', b'abc')
+        self.fakeio_session.create_file("/memfile/sub/b.txt", 'rw', "あ")
+
+    def test_should_find_fake_files_and_directories(self):
+        with self.fakeio_session:
+            self.assertTrue(os.path.exists("/memfile/a.txt"))
+            self.assertTrue(os.path.isfile("/memfile\\sub\\b.txt"))
+            self.assertFalse(os.path.isdir("/memfile/a.txt"))
+            self.assertTrue(os.path.isdir("/memfile/sub/"))
+            self.assertFalse(os.path.exists("/memfile/c.txt"))
+            self.assertTrue(os.path.isfile(__file__))
+        self.assertFalse(os.path.exists("/memfile/a.txt"))
+
+    def test_should_not_find_empty_path(self):
+        with self.fakeio_session:
+            self.assertFalse(os.path.exists(""))
+            self.assertFalse(os.path.isdir(""))
+            self.assertRaises(OSError, os.listdir, "")
+            self.assertRaises(OSError, os.stat, "")
+
+    def test_should_list_fake_directory(self):
+        with self.fakeio_session:
+            self.assertEqual(os.listdir("/memfile"), ["a.txt", "sub"])
+            self.assertIn("memfile", os.listdir("/"))
+            self.assertIn("test___init__.py",
+                          os.listdir(os.path.dirname(__file__)))
+
+    def test_should_walk_fake_directory(self):
+        with self.fakeio_session:
+            walked = list(os.walk("/memfile"))
+        self.assertEqual(walked, [("/memfile", ["sub"], ["a.txt"]),
+                                  ("/memfile/sub", [], ["b.txt"])])
+
+    def test_should_stat_fake_file(self):
+        with self.fakeio_session:
+            self.assertEqual(os.stat("/memfile/a.txt").st_size, 3)
+            self.assertEqual(os.path.getsize("/memfile/sub/b.txt"), 3)
+            self.assertTrue(stat.S_ISDIR(os.stat("/memfile/sub").st_mode))
+            self.assertTrue(stat.S_ISREG(os.stat(__file__).st_mode))
+
+    def test_should_forget_removed_directory(self):
+        snapshot = self.fakeio_session.snapshot()
+        self.fakeio_session.create_file("/memfile/new/c.txt", 'r', b'')
+        self.fakeio_session.restore(snapshot)
+        with self.fakeio_session:
+            self.assertFalse(os.path.exists("/memfile/new"))
+            self.assertTrue(os.path.exists("/memfile/sub"))
+
+    def test_should_hook_os_in_thread_scope(self):
+        fakeio_session = fakeio.FakeIOSession(scope='thread')
+        fakeio_session.create_file("/memfile/a.txt", 'r', b'abc')
+        with fakeio_session:
+            self.assertEqual(os.listdir("/memfile"), ["a.txt"])
+        self.assertFalse(os.path.exists("/memfile"))
+
+    def test_should_read_and_write_fake_descriptors(self):
+        with self.fakeio_session:
+            fd = os.open("/memfile/a.txt", os.O_RDONLY)
+            self.assertEqual(os.read(fd, 2), b'ab')
+            self.assertEqual(os.fstat(fd).st_size, 3)
+            self.assertEqual(stat.S_IMODE(os.fstat(fd).st_mode), 0o444)
+            os.close(fd)
+            with self.assertRaises(OSError) as raised:
+                os.open("/memfile/a.txt", os.O_WRONLY)
+            self.assertEqual(raised.exception.errno, errno.EACCES)
+            fd = os.open("/memfile/sub/b.txt", os.O_WRONLY | os.O_APPEND)
+            with self.assertRaises(OSError) as raised:
+                os.open("/memfile/sub/b.txt", os.O_RDWR)
+            self.assertEqual(raised.exception.errno, errno.EBUSY)
+            os.write(fd, b'!')
+            os.close(fd)
+            with self.assertRaises(OSError) as raised:
+                os.open("/memfile/sub/b.txt",
+                        os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            self.assertEqual(raised.exception.errno, errno.EEXIST)
+        fileobj = self.fakeio_session.mappings["/memfile/sub/b.txt"]
+        self.assertEqual(fileobj.getvalue(), "あ!")
+
+    def test_should_keep_writes_of_descriptor_closed_by_fdopen(self):
+        with self.fakeio_session:
+            fd = os.open("/memfile/sub/b.txt", os.O_WRONLY | os.O_TRUNC)
+            with os.fdopen(fd, 'wb') as writer:
+                writer.write(b'new')
+            fileobj = self.fakeio_session.mappings["/memfile/sub/b.txt"]
+            self.assertEqual(fileobj.getvalue(), "new")
+            self.assertEqual(self.fakeio_session._descriptors, {})
+            fd = os.open("/memfile/sub/b.txt", os.O_RDWR)
+            with io.open(fd, 'rb') as reader:
+                self.assertEqual(reader.read(), b'new')
+            # The number now belongs to a real file
+            with io.open(__file__, 'rb') as real:
+                self.assertEqual(os.fstat(real.fileno()).st_size,
+                                 os.path.getsize(__file__))
+            self.assertEqual(self.fakeio_session._descriptors, {})
+            with open("/memfile/sub/b.txt", 'w') as writer:
+                writer.write("again")
+        self.assertEqual(fileobj.getvalue(), "again")
+
+    def test_should_make_temporary_files_in_fake_directory(self):
+        fakeio_session = fakeio.FakeIOSession()
+        fakeio_session.intercept_regex(re.compile("^/memfile/"))
+        with fakeio_session:
+            fd, path = tempfile.mkstemp(dir="/memfile")
+            os.write(fd, b'abc')
+            os.close(fd)
+        self.assertEqual(list(fakeio_session.mappings), [path])
+        self.assertEqual(fakeio_session.mappings[path].getvalue(), b'abc')
+
+    def test_should_share_with_catch_all_regex(self):
+        fakeio_session = fakeio.FakeIOSession(memory_budget=1)
+        share = fakeio_session.share()
+        try:
+            fakeio_session.intercept_regex(re.compile(".*"))
+            with fakeio_session:
+                with open("/memfile/a.txt", 'w') as writer:
+                    writer.write("abc")
+                with open("/memfile/b.txt", 'w') as writer:
+                    writer.write("def")
+                with open("/memfile/a.txt") as reader:
+                    self.assertEqual(reader.read(), "abc")
+        finally:
+            share.close()
+
+    def test_should_mmap_fake_files(self):
+        import mmap
+        with self.fakeio_session:
+            fd = os.open("/memfile/sub/b.txt", os.O_RDWR)
+            mapped = mmap.mmap(fd, 0)
+            self.assertEqual(mapped[:], "あ".encode('utf8'))
+            mapped.seek(0)
+            mapped.write(b'xyz')
+            mapped.close()
+            os.close(fd)
+            with open("/memfile/a.txt") as fileobj:
+                mapped = mmap.mmap(fileobj.fileno(), 0, prot=mmap.PROT_READ)
+                self.assertEqual(mapped[:], b'abc')
+                mapped.close()
+            with io.open("/memfile/a.txt", 'rb') as fileobj:
+                self.assertEqual(os.fstat(fileobj.fileno()).st_size, 3)
+        fileobj = self.fakeio_session.mappings["/memfile/sub/b.txt"]
+        self.assertEqual(fileobj.getvalue(), "xyz")
+        self.assertEqual(fileobj._readers, [])
+
 class FakeIOFileTest(unittest.TestCase):
 
     def test_should_getvalue(self):
@@ -234,11 +1370,53 @@ class FakeIOFileTest(unittest.TestCase):
         fileobj.close()
         self.assertEqual(file.getvalue(), content)
 
-    def test_should_open_only_one(self):
+    def test_should_open_only_one_writer(self):
         file = fakeio.FakeIOFile("/memfile/something.txt", "rw", '')
-        file.open('r')
+        file.open('w')
+        with self.assertRaises(IOError):
+            file.open('a')
+
+    def test_should_open_readers_simultaneously(self):
+        file = fakeio.FakeIOFile("/memfile/something.txt", "rw", 'abc\ndef\n')
+        first = file.open('r')
+        second = file.open('r')
+        self.assertEqual(first.readline(), 'abc\n')
+        self.assertEqual(second.read(), 'abc\ndef\n')
+        self.assertEqual(first.read(), 'def\n')
+        first.close()
+        second.close()
+        self.assertEqual(file.getvalue(), 'abc\ndef\n')
+
+    def test_should_isolate_readers_from_writer(self):
+        file = fakeio.FakeIOFile("/memfile/something.txt", "rw", 'some')
+        reader = file.open('r')
+        writer = file.open('a')
+        writer.write('thing')
+        writer.close()
+        self.assertEqual(reader.read(), 'some')
+        reader.close()
+        self.assertEqual(file.open('r').read(), 'something')
+
+    def test_should_not_write_to_reader(self):
+        file = fakeio.FakeIOFile("/memfile/something.txt", "rw", 'some')
         with self.assertRaises(IOError):
-            file.open('r')
+            file.open('r').write('thing')
+
+    def test_should_not_close_reader_twice(self):
+        file = fakeio.FakeIOFile("/memfile/something.txt", "rw", 'some')
+        fileobj = file.open('r')
+        fileobj.close()
+        with self.assertRaises(fakeio.ProgrammingException):
+            fileobj.close()
+
+    def test_should_seek_reader(self):
+        file = fakeio.FakeIOFile("/memfile/something.txt", "rw", 'something')
+        fileobj = file.open('r')
+        fileobj.seek(-5, os.SEEK_END)
+        self.assertEqual(fileobj.read(2), 'th')
+        self.assertEqual(fileobj.tell(), 6)
+        fileobj.seek(0)
+        self.assertEqual(fileobj.readlines(), ['something'])
 
     def test_should_open_twice(self):
         file = fakeio.FakeIOFile("/memfile/something.txt", "rw", '')
@@ -253,6 +1431,54 @@ class FakeIOFileTest(unittest.TestCase):
         fileobj.close()
         self.assertEqual(file.getvalue(), 'something')
 
+    def test_should_update_with_mode_r_plus(self):
+        for open_binary in (lambda file: file.open('r+'),
+                            lambda file: file.io_open('r+b')):
+            file = fakeio.FakeIOFile("/memfile/something.txt", "rw",
+                                     b'something')
+            fileobj = open_binary(file)
+            self.assertEqual(fileobj.read(4), b'some')
+            fileobj.seek(0)
+            fileobj.write(b'any')
+            fileobj.close()
+            self.assertEqual(file.getvalue(), b'anyething')
+        file = fakeio.FakeIOFile("/memfile/something.txt", "r", b'')
+        self.assertRaises(ValueError, file.open, 'r+')
+
+    def test_should_truncate_with_mode_w(self):
+        file = fakeio.FakeIOFile("/memfile/something.txt", "rw", 'something')
+        fileobj = file.open('w')
+        fileobj.write('any')
+        fileobj.close()
+        self.assertEqual(file.getvalue(), 'any')
+
+    def test_should_append_many_times(self):
+        file = fakeio.FakeIOFile("/memfile/something.txt", "rw", '')
+        for i in range(100):
+            fileobj = file.open('a')
+            fileobj.write('%d\n' % i)
+            fileobj.close()
+        self.assertEqual(file.getvalue(),
+                         ''.join('%d\n' % i for i in range(100)))
+
+    def test_should_write_in_the_middle_of_appended_content(self):
+        file = fakeio.FakeIOFile("/memfile/something.txt", "rw", 'some')
+        fileobj = file.open('a')
+        fileobj.write('thing')
+        fileobj.seek(1)
+        fileobj.write('a')
+        self.assertEqual(fileobj.read(), 'mething')
+        self.assertEqual(fileobj.tell(), 9)
+        fileobj.close()
+        self.assertEqual(file.getvalue(), 'samething')
+
+    def test_should_read_appended_content(self):
+        file = fakeio.FakeIOFile("/memfile/something.txt", "rw", 'some')
+        fileobj = file.open('a')
+        fileobj.write('thing')
+        fileobj.close()
+        self.assertEqual(file.open('r').read(), 'something')
+
     def test_should_not_open_readonly_file_with_mode_w(self):
         file = fakeio.FakeIOFile("/memfile/something.txt", "r", '')
         with self.assertRaises(ValueError):
@@ -283,12 +1509,223 @@ class FakeIOFileTest(unittest.TestCase):
         fileobj = file.open("r")
         self.assertIsInstance(fileobj.read(), str)
 
+    def test_io_open_shares_content_between_readers(self):
+        file = fakeio.FakeIOFile("/memfile/something.txt", "rw", "a\nb\n", 'utf8')
+        first = file.io_open("r", 'utf8')
+        with file.io_open("r", 'utf8') as second:
+            self.assertEqual(list(second), ["a\n", "b\n"])
+        self.assertEqual(first.read(), "a\nb\n")
+
     def test_io_open_opens_file_in_text_mode(self):
         content = "あいうえお"
         file = fakeio.FakeIOFile("/memfile/something.txt", "rw", content, 'utf8')
         fileobj = file.io_open("r", 'utf8')
         self.assertIsInstance(fileobj.read(), unicode)
 
+    def test_io_open_decodes_only_what_is_read(self):
+        content = "あ\n".encode('utf8') * 100000
+        file = fakeio.FakeIOFile("/memfile/something.txt", "rw", content, 'utf8')
+        with file.io_open("r") as fileobj:
+            self.assertEqual(fileobj.readline(), "あ\n")
+        self.assertIsNone(file._decoded)
+
+    def test_io_open_translates_newlines(self):
+        content = b"a\r\nb\rc\n"
+        file = fakeio.FakeIOFile("/memfile/something.txt", "rw", content)
+        with file.io_open("r") as fileobj:
+            self.assertEqual(list(fileobj), ["a\n", "b\n", "c\n"])
+        with file.io_open("r", newline='') as fileobj:
+            self.assertEqual(list(fileobj), ["a\r\n", "b\r", "c\n"])
+        with file.io_open("w", newline='\r\n') as fileobj:
+            fileobj.write("x\ny")
+        self.assertEqual(file.getvalue(), "x\r\ny")
+
+    def test_io_open_splits_text_at_requested_newline(self):
+        for content in ["a\nb\rc\r\nd", b"a\nb\rc\r\nd"]:
+            file = fakeio.FakeIOFile("/memfile/something.txt", "r", content)
+            with file.io_open("r", newline='\r') as fileobj:
+                self.assertEqual(list(fileobj), ["a\nb\r", "c\r", "\nd"])
+            with file.io_open("r", newline='\r\n') as fileobj:
+                self.assertEqual(list(fileobj), ["a\nb\rc\r\n", "d"])
+        file = fakeio.FakeIOFile("/memfile/something.txt", "r", "a\nb")
+        with file.io_open("r", newline='\r') as fileobj:
+            self.assertEqual(list(fileobj), ["a\nb"])
+
+    def test_io_open_handles_decoding_errors(self):
+        file = fakeio.FakeIOFile("/memfile/something.txt", "rw", b"a\xff", 'utf8')
+        with file.io_open("r", errors='replace') as fileobj:
+            self.assertEqual(fileobj.read(), "a\ufffd")
+        with file.io_open("r") as fileobj:
+            self.assertRaises(UnicodeDecodeError, fileobj.read)
+
+    def test_io_open_truncates_or_appends_text(self):
+        file = fakeio.FakeIOFile("/memfile/something.txt", "rw", "old")
+        with file.io_open("a") as fileobj:
+            fileobj.write("あ")
+        self.assertEqual(file.getvalue(), "oldあ")
+        with file.io_open("w") as fileobj:
+            fileobj.write("new")
+        self.assertEqual(file.getvalue(), "new")
+
+    def test_io_open_opens_file_in_binary_mode(self):
+        content = "あいうえお"
+        file = fakeio.FakeIOFile("/memfile/something.txt", "rw", content, 'utf8')
+        with file.io_open("rb", None) as fileobj:
+            self.assertEqual(fileobj.read(), content.encode('utf8'))
+
+    def test_io_open_reads_into_buffer(self):
+        file = fakeio.FakeIOFile("/memfile/something.bin", "rw", b'abcdef')
+        with file.io_open("rb", None) as fileobj:
+            buffer = bytearray(4)
+            self.assertEqual(fileobj.readinto(buffer), 4)
+            self.assertEqual(buffer, bytearray(b'abcd'))
+            self.assertEqual(fileobj.readinto(buffer), 2)
+            self.assertEqual(buffer[:2], bytearray(b'ef'))
+            self.assertEqual(fileobj.readinto(buffer), 0)
+            self.assertEqual(fileobj.getbuffer().tobytes(), b'abcdef')
+            fileobj.seek(1)
+            self.assertEqual(fileobj.read1(2), b'bc')
+
+    def test_io_open_writes_and_appends_in_binary_mode(self):
+        file = fakeio.FakeIOFile("/memfile/something.bin", "rw", b'old')
+        with file.io_open("wb", None) as fileobj:
+            fileobj.write(b'ab')
+        with file.io_open("ab", None) as fileobj:
+            fileobj.write(b'cd')
+            self.assertEqual(fileobj.getbuffer().tobytes(), b'abcd')
+        self.assertEqual(file.getvalue(), b'abcd')
+        self.assertRaises(ValueError, file.io_open, "xb", None)
+
+    def test_should_not_encode_unchanged_content_again(self):
+        content = "あいうえお"
+        file = fakeio.FakeIOFile("/memfile/something.txt", "rw", content, 'utf8')
+        first = file.open("r")
+        first_content = first.read()
+        first.close()
+        second = file.open("r")
+        self.assertIs(second.read(), first_content)
+
+    def test_should_not_decode_unchanged_content_again(self):
+        content = "あいうえお\n".encode('utf8')
+        file = fakeio.FakeIOFile("/memfile/something.txt", "rw", content, 'utf8')
+        with file.io_open("r") as fileobj:
+            first = fileobj.read()
+        with file.io_open("r") as fileobj:
+            self.assertIs(fileobj.read(), first)
+
+    def test_should_not_keep_translated_newlines(self):
+        content = "a\r\nb".encode('utf8')
+        file = fakeio.FakeIOFile("/memfile/something.txt", "rw", content, 'utf8')
+        with file.io_open("r") as fileobj:
+            self.assertEqual(fileobj.read(), "a\nb")
+        with file.io_open("r", newline='') as fileobj:
+            self.assertEqual(fileobj.read(), "a\r\nb")
+
+    def test_should_not_write_to_text_reader(self):
+        for content in ("a\rb", "a\rb".encode('utf8')):
+            file = fakeio.FakeIOFile("/memfile/something.txt", "rw", content,
+                                     'utf8')
+            for newline in (None, '', '\n', '\r'):
+                with file.io_open("r", newline=newline) as fileobj:
+                    self.assertRaises(IOError, fileobj.write, "zz")
+            self.assertEqual(file.getvalue(), content)
+
+    def test_should_invalidate_transcoded_content_when_written(self):
+        file = fakeio.FakeIOFile("/memfile/something.txt", "rw", "some", 'utf8')
+        file.io_open("r", 'utf8').close()
+        fileobj = file.open("w")
+        fileobj.write("thing".encode('utf8'))
+        fileobj.close()
+        self.assertEqual(file.io_open("r", 'utf8').read(), "thing")
+
+class RegexMatcherTest(unittest.TestCase):
+
+    def test_should_match_any_registered_regex(self):
+        matcher = fakeio._RegexMatcher()
+        matcher.add(re.compile("^/memfile/"))
+        matcher.add(re.compile("^/tmp/.*\\.log$"))
+        self.assertTrue(matcher.match("/memfile/something.txt"))
+        self.assertTrue(matcher.match("/tmp/out.log"))
+        self.assertFalse(matcher.match("/tmp/out.txt"))
+
+    def test_should_match_regex_added_after_first_match(self):
+        matcher = fakeio._RegexMatcher()
+        matcher.add(re.compile("^/memfile/"))
+        self.assertFalse(matcher.match("/other/something.txt"))
+        matcher.add(re.compile("^/other/"))
+        self.assertTrue(matcher.match("/other/something.txt"))
+
+    def test_should_keep_flags_of_each_regex(self):
+        matcher = fakeio._RegexMatcher()
+        matcher.add(re.compile("^/memfile/", re.IGNORECASE))
+        matcher.add(re.compile("^/other/"))
+        self.assertTrue(matcher.match("/MEMFILE/something.txt"))
+        self.assertFalse(matcher.match("/OTHER/something.txt"))
+
+    def test_should_match_verbose_regex_with_comment(self):
+        matcher = fakeio._RegexMatcher()
+        matcher.add(re.compile("^/memfile/  # fake files", re.VERBOSE))
+        matcher.add(re.compile("^/other/  # other files", re.VERBOSE))
+        self.assertTrue(matcher.match("/other/something.txt"))
+
+    def test_should_match_regex_with_backreference(self):
+        matcher = fakeio._RegexMatcher()
+        matcher.add(re.compile("^/(a+)/"))
+        matcher.add(re.compile("^/(b+)/\\1$"))
+        self.assertTrue(matcher.match("/bb/bb"))
+        self.assertFalse(matcher.match("/bb/b"))
+
+    def test_should_match_many_regexes_with_groups(self):
+        matcher = fakeio._RegexMatcher()
+        for i in range(300):
+            matcher.add(re.compile("^/memfile%d/(?P<name>.*)$" % i))
+        self.assertTrue(matcher.match("/memfile299/something.txt"))
+        self.assertFalse(matcher.match("/memfile300/something.txt"))
+        self.assertEqual(len(matcher), 300)
+
+class LiteralPrefixTest(unittest.TestCase):
+
+    def test_should_return_anchored_literal_prefix(self):
+        prefix = fakeio._literal_prefix(re.compile("^/memfile/.*\\.txt$"))
+        self.assertEqual(prefix, "/memfile/")
+
+    def test_should_stop_at_optional_character(self):
+        prefix = fakeio._literal_prefix(re.compile("/memfiles?/"))
+        self.assertEqual(prefix, "/memfile")
+
+    def test_should_return_empty_prefix_for_ignorecase(self):
+        prefix = fakeio._literal_prefix(re.compile("^/memfile/", re.I))
+        self.assertEqual(prefix, "")
+
+    def test_should_return_empty_prefix_for_alternation(self):
+        prefix = fakeio._literal_prefix(re.compile("^a/|^b/"))
+        self.assertEqual(prefix, "")
+
+class PrefixFilterTest(unittest.TestCase):
+
+    def test_should_reject_everything_when_empty(self):
+        prefix_filter = fakeio._PrefixFilter()
+        self.assertFalse(prefix_filter.may_match("/memfile/something.txt"))
+
+    def test_should_reject_path_out_of_prefixes(self):
+        prefix_filter = fakeio._PrefixFilter()
+        prefix_filter.add("/memfile/something.txt")
+        prefix_filter.add("/memfile/")
+        self.assertTrue(prefix_filter.may_match("/memfile/other.txt"))
+        self.assertTrue(prefix_filter.may_match("/memfile\\other.txt"))
+        self.assertFalse(prefix_filter.may_match("/usr/lib/other.txt"))
+
+    def test_should_accept_everything_with_empty_prefix(self):
+        prefix_filter = fakeio._PrefixFilter()
+        prefix_filter.add("/memfile/")
+        prefix_filter.add("")
+        self.assertTrue(prefix_filter.may_match("/usr/lib/other.txt"))
+
+    def test_should_reject_file_descriptor(self):
+        prefix_filter = fakeio._PrefixFilter()
+        prefix_filter.add("")
+        self.assertFalse(prefix_filter.may_match(3))
+
 class NormalizePathTest(unittest.TestCase):
 
     def test_should_normalize_windows_path(self):